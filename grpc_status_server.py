@@ -1,212 +1,2473 @@
-from collections import defaultdict
-import concurrent.futures
-from flask import Flask, render_template_string
+from array import array
+import asyncio
+import bisect
+from collections import OrderedDict, deque
+from flask import Flask, Response, render_template_string, request
 import grpc
+import gzip
 from grpc_reflection.v1alpha import reflection_pb2, reflection_pb2_grpc
+import proto.xmtpv4.metadata_api.metadata_api_pb2 as metadata_api_pb2
+import proto.xmtpv4.metadata_api.metadata_api_pb2_grpc as metadata_api_pb2_grpc
+import heapq
 import json
+import math
+import numpy as np
 import os
+import random
+import requests
+from requests.adapters import HTTPAdapter
+import socket
+import sqlite3
+import tempfile
 import time
 from web3 import Web3
 import threading
 
-addresses = {}
-errors = defaultdict(str)
-versions = defaultdict(str)
+# Latest NodeState per registry address. The probe loop replaces a node's
+# record whole and swaps in a new dict when nodes join or leave, so other
+# threads can read it without locks.
+node_states = {}
+# Rolling latency windows and metrics histograms per node.
+latencies = {}
+probe_histograms = {}
+# ProbeHistory per node, and its latest uptime and latency summary, plus the
+# uptime over HISTORY_DB_WINDOWS and when it was last read.
+probe_history = {}
+history_summaries = {}
+database_uptime = {}
+database_uptime_read = 0.0
+# Probe samples waiting to be written to the history database, which the
+# probe loop opens, and the event that asks for an early flush.
+pending_samples = []
+history_db = None
+history_flush = None
+# NodeHealth per node.
+node_health = {}
+# Health transitions waiting to be alerted on, created by the probe loop,
+# and the last state each node was alerted as.
+alert_queue = None
+alerted_states = {}
+# Latest result per node, pushed to the aggregator on every push, and on the
+# aggregator the latest (status code, latency ms, probed at, heard at) per
+# node and vantage.
+outbound_results = {}
+vantage_results = {}
+vantage_lock = threading.Lock()
+# Encoded /history responses by query, oldest first.
+history_cache = OrderedDict()
+history_cache_lock = threading.Lock()
+sweep_stats = {"registry_sync_seconds": {}, "snapshot_written": 0.0}
+# Set whenever state shown in /data changes; cleared when it is republished.
+# extra_changed is the same for state shared outside /data, such as lag.
+state_changed = False
+extra_changed = False
+# Latest published /data document, and the condition /events streams wait on.
+data_snapshot = None
+snapshot_published = threading.Condition()
+# Latency percentiles as last published by the prober, in web workers, and
+# whether they serve a stale stand-in because the prober stopped beating.
+shared_latency = {}
+prober_stale = False
+# Prometheus exposition, rebuilt at most every METRICS_INTERVAL once new
+# probe results are in.
+metrics_body = b""
+metrics_changed = False
+# Latest sync cursor per node (originator node ID -> sequence ID), the lag
+# matrix built from them and a per-node lag summary.
+sync_cursors = {}
+cursor_stream_states = {}
+cursors_changed = False
+lag_matrix = {}
+replication_lag = {}
+# Long-lived gRPC channels, keyed by address.
+channels = {}
+# Reflection results per address: services, version and when they were fetched.
+capabilities = {}
+# Per network: its registry indexer, the canonical node addresses from the
+# last successful sync, and all registry nodes for /registry.
+registries = {}
+network_addresses = {}
+registry_nodes = {}
 app = Flask(__name__)
 
-# Global executor.
-executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
+def load_networks():
+    """
+    Parses NETWORKS, a comma-separated list of name=descriptor.json entries,
+    into {name: descriptor path}. Defaults to the testnet descriptor.
+    """
+    networks = {}
+    for entry in os.environ.get("NETWORKS", "testnet=testnet.json").split(","):
+        name, _, path = entry.strip().partition("=")
+        networks[name] = path or f"{name}.json"
+    return networks
 
-def get_addresses():
-    web3 = Web3(Web3.HTTPProvider(os.environ["WEB3_PROVIDER_URI"]))
+NETWORKS = load_networks()
+
+def private_state_path():
+    """
+    Default SHARED_STATE_PATH: files in a temp directory only this user can
+    reach. A directory of that name that belongs to someone else or is open
+    to others is refused rather than trusted.
+    """
+    directory = os.path.join(tempfile.gettempdir(), f"xmtp-node-status-{os.getuid()}")
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if os.path.islink(directory) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise SystemExit(f"{directory} is not a private directory; set SHARED_STATE_PATH")
+    return os.path.join(directory, "state")
 
-    if not web3.is_connected():
-        raise ConnectionError("Failed to connect to the network")
+# Last registry view and probe results, persisted for warm starts.
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", "status_snapshot.json.gz")
+SNAPSHOT_INTERVAL = 15
 
-    with open("NodeRegistry.abi.json", "r") as abi_file:
-        contract = json.load(abi_file)
+# "all" probes and serves in one process. "prober" only probes and publishes
+# to files named SHARED_STATE_PATH plus a suffix per kind of state; "web"
+# workers only serve what it published. The data file carries the newest
+# SHARED_CHANGE_LOG_SIZE change log entries, which workers append to their
+# own CHANGE_LOG_SIZE log. The prober also touches a heartbeat file on every
+# publish pass; once it is SHARED_STALE_AFTER old, workers serve every node as
+# stale. Batches pushed to a web worker's /ingest go the other way, as files
+# in the INGEST_SPOOL_PATH directory that the prober applies and removes;
+# past INGEST_SPOOL_SIZE files /ingest answers 503.
+ROLE = os.environ.get("ROLE", "all")
+SHARED_STATE_PATH = os.environ.get("SHARED_STATE_PATH") or (private_state_path() if ROLE != "all" else "")
+SHARED_CHANGE_LOG_SIZE = 64
+SHARED_STALE_AFTER = 5
+INGEST_SPOOL_PATH = f"{SHARED_STATE_PATH}.ingest"
+INGEST_SPOOL_SIZE = 1000
+# Shortest gap between two published /data snapshots, and how many versions
+# of node changes are kept for /data?since=N.
+PUBLISH_INTERVAL = 0.5
+CHANGE_LOG_SIZE = 1000
+METRICS_INTERVAL = 5
+# Idle /events streams get a comment line this often to keep proxies open.
+# Streams carry deltas, plus the full document at most every
+# SSE_REFRESH_INTERVAL when only node summaries changed.
+SSE_KEEPALIVE = 15
+SSE_REFRESH_INTERVAL = 60
+# Each open stream holds a server thread. Past SSE_MAX_STREAMS (0 for no
+# limit) /events answers 503 and dashboards poll /data instead.
+SSE_MAX_STREAMS = int(os.environ.get("SSE_MAX_STREAMS", "0"))
+stream_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS) if SSE_MAX_STREAMS else None
 
-    with open("testnet.json", "r") as json_file:
-        testnet = json.load(json_file)
-        contract_address = testnet["nodeRegistry"]
+# Maximum number of probes in flight at once on the event loop.
+PROBE_CONCURRENCY = int(os.environ.get("PROBE_CONCURRENCY", "100"))
+# How often registry logs are read, how often the full node list is
+# re-read as a safety net, and the block range of each log query.
+REGISTRY_INTERVAL = 15
+REGISTRY_RECONCILE_INTERVAL = int(os.environ.get("REGISTRY_RECONCILE_INTERVAL", "3600"))
+LOG_CHUNK_BLOCKS = int(os.environ.get("LOG_CHUNK_BLOCKS", "10000"))
+# Keep-alive connections held open to the JSON-RPC provider, and the
+# timeout for each request.
+REGISTRY_POOL_SIZE = 4
+REGISTRY_TIMEOUT = 10
+# Most contract calls packed into a single JSON-RPC batch request.
+REGISTRY_BATCH_SIZE = 500
+# Probe scheduling: steady-state interval, quick re-probe after a state change,
+# and exponential backoff for nodes that have been down for a while.
+PROBE_INTERVAL = int(os.environ.get("PROBE_INTERVAL", "15"))
+FAST_REPROBE_INTERVAL = 2
+FAILURES_BEFORE_BACKOFF = 4
+MAX_PROBE_INTERVAL = int(os.environ.get("MAX_PROBE_INTERVAL", "300"))
+PROBE_JITTER = 0.1
+# Deadlines for each probe phase: DNS, TCP, TLS and HTTP/2 setup on a new
+# channel, then the reflection walk and GetVersion.
+CONNECT_TIMEOUT = 5
+REFLECTION_TIMEOUT = 5
+VERSION_TIMEOUT = 3
+# How long a node's reflection service list is trusted before it is re-read.
+CAPABILITY_TTL = int(os.environ.get("CAPABILITY_TTL", "600"))
+# Cursors are streamed with SubscribeSyncCursor. Nodes without a live stream
+# are polled with GetSyncCursor every SYNC_CURSOR_INTERVAL instead.
+SYNC_CURSOR_INTERVAL = int(os.environ.get("SYNC_CURSOR_INTERVAL", "30"))
+CURSOR_TIMEOUT = 3
+STREAM_STALL_TIMEOUT = int(os.environ.get("STREAM_STALL_TIMEOUT", "60"))
+STREAM_MIN_BACKOFF = 1
+STREAM_MAX_BACKOFF = 60
+# Replication lag is recomputed at most this often while cursors change.
+LAG_INTERVAL = 1
+# Number of recent samples kept per node and phase for latency percentiles.
+LATENCY_WINDOW = int(os.environ.get("LATENCY_WINDOW", "256"))
+# Upper bounds, in seconds, of the /metrics probe latency histogram buckets.
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Probe history kept in memory per node: enough samples for HISTORY_RETENTION
+# at the regular probe interval, summarized over each of HISTORY_WINDOWS every
+# HISTORY_SUMMARY_INTERVAL. Buffers start at HISTORY_INITIAL_SIZE samples and
+# double as they fill. Uptime over HISTORY_DB_WINDOWS comes from the hour and
+# minute rollups in the history database instead, every HISTORY_DB_INTERVAL.
+HISTORY_RETENTION = 24 * 3600
+HISTORY_SIZE = int(os.environ.get("HISTORY_SIZE", str(HISTORY_RETENTION // PROBE_INTERVAL)))
+HISTORY_INITIAL_SIZE = 256
+HISTORY_PHASES = ("dns", "connect", "reflection", "version")
+HISTORY_WINDOWS = (("1h", 3600), ("24h", HISTORY_RETENTION))
+HISTORY_DB_WINDOWS = (("7d", 7 * 24 * 3600),)
+HISTORY_SUMMARY_INTERVAL = 30
+HISTORY_DB_INTERVAL = 300
+# Probe results are also written to a SQLite database every
+# HISTORY_FLUSH_INTERVAL, or sooner once HISTORY_FLUSH_ROWS are pending. Raw
+# samples are rolled up into per-minute and per-hour aggregates every
+# ROLLUP_INTERVAL, once they are ROLLUP_DELAY old, and each table is pruned
+# to its retention.
+HISTORY_DB_PATH = os.environ.get("HISTORY_DB_PATH", "status_history.db")
+HISTORY_FLUSH_INTERVAL = PROBE_INTERVAL
+HISTORY_FLUSH_ROWS = 500
+ROLLUP_INTERVAL = 60
+ROLLUP_DELAY = 120
+RAW_RETENTION = int(os.environ.get("RAW_RETENTION", str(2 * 24 * 3600)))
+MINUTE_RETENTION = int(os.environ.get("MINUTE_RETENTION", str(30 * 24 * 3600)))
+HOUR_RETENTION = int(os.environ.get("HOUR_RETENTION", str(400 * 24 * 3600)))
+# /history/<address> returns at most HISTORY_MAX_POINTS buckets. Recent
+# responses are cached for HISTORY_CACHE_TTL seconds.
+HISTORY_DEFAULT_POINTS = 500
+HISTORY_MAX_POINTS = 5000
+HISTORY_CACHE_SIZE = 256
+HISTORY_CACHE_TTL = 30
+# Hysteresis for a node's health: FAILURES_TO_DOWN failed probes in a row
+# mark it down, SUCCESSES_TO_UP successful ones bring it back. Each up/down
+# flip of the raw result adds one to its flap score, which halves every
+# FLAP_HALF_LIFE seconds; a score above FLAP_THRESHOLD counts as flapping.
+FAILURES_TO_DOWN = int(os.environ.get("FAILURES_TO_DOWN", "3"))
+SUCCESSES_TO_UP = int(os.environ.get("SUCCESSES_TO_UP", "2"))
+FLAP_HALF_LIFE = 600
+FLAP_THRESHOLD = 3
+INCIDENT_LOG_SIZE = 500
+# The most recent incidents, oldest first.
+incidents = deque(maxlen=INCIDENT_LOG_SIZE)
+# Health transitions are sent to each of ALERT_SINKS ("stdout" or a webhook
+# URL). Transitions within ALERT_GROUP_WINDOW go out as one notification,
+# and each sink sends at most one per ALERT_MIN_INTERVAL, retrying failed
+# deliveries up to ALERT_RETRIES times with exponential backoff.
+ALERT_SINKS = [sink.strip() for sink in os.environ.get("ALERT_SINKS", "stdout").split(",") if sink.strip()]
+ALERT_QUEUE_SIZE = 1000
+ALERT_GROUP_WINDOW = float(os.environ.get("ALERT_GROUP_WINDOW", "5"))
+ALERT_MIN_INTERVAL = float(os.environ.get("ALERT_MIN_INTERVAL", "30"))
+ALERT_RETRIES = 5
+ALERT_MIN_BACKOFF = 1
+ALERT_MAX_BACKOFF = 60
+ALERT_TIMEOUT = 10
+# Federation: a prober with AGGREGATOR_URL pushes its latest result per node
+# to that aggregator's /ingest every PUSH_INTERVAL, as vantage VANTAGE, even
+# when the node has not been probed again since, so backed-off nodes stay
+# reported. An aggregator (AGGREGATE=1) merges the pushes with its own results
+# and calls a node up when more than half of the vantages heard from within
+# VANTAGE_TTL see it up. Pushes must carry INGEST_TOKEN, and reports not heard
+# within VANTAGE_RETENTION are dropped.
+AGGREGATOR_URL = os.environ.get("AGGREGATOR_URL", "")
+AGGREGATE = os.environ.get("AGGREGATE") == "1"
+VANTAGE = os.environ.get("VANTAGE", socket.gethostname())
+INGEST_TOKEN = os.environ.get("INGEST_TOKEN", "")
+PUSH_INTERVAL = 5
+PUSH_TIMEOUT = 10
+VANTAGE_TTL = int(os.environ.get("VANTAGE_TTL", str(4 * PROBE_INTERVAL)))
+VANTAGE_RETENTION = 3 * VANTAGE_TTL
+if AGGREGATE and not INGEST_TOKEN:
+    # Anyone who can reach /ingest could otherwise vote on node health.
+    raise SystemExit("AGGREGATE=1 requires INGEST_TOKEN")
 
-    # Load the contract
-    contract = web3.eth.contract(address=contract_address, abi=contract)
+METADATA_SERVICE = "xmtp.xmtpv4.metadata_api.MetadataApi"
 
-    result = contract.functions.getAllNodes().call()
+# Keepalive options shared by every probe channel.
+CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', 30000),
+    ('grpc.keepalive_timeout_ms', 5000),
+    ('grpc.keepalive_permit_without_calls', True),
+    ('grpc.http2.max_pings_without_data', 0),
+    ('grpc.http2.min_time_between_pings_ms', 10000),
+    ('grpc.http2.min_ping_interval_without_data_ms', 300000)
+]
+CHANNEL_CREDENTIALS = grpc.ssl_channel_credentials()
 
-    canonical_nodes = [
-        node[1][3].replace("https://", "") + ":443"
-        for node in result
-        if node[1][1] is True and node[1][3]  # isCanonical and has httpAddress
-    ]
+class RegistryClient:
+    """
+    Long-lived connection to the NodeRegistry contract. The ABI and network
+    descriptor are read once, and every JSON-RPC call goes through one
+    pooled keep-alive HTTP session.
+    """
+
+    def __init__(self, provider_uri, config_path="testnet.json"):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=REGISTRY_POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        provider = Web3.HTTPProvider(
+            provider_uri,
+            session=session,
+            request_kwargs={"timeout": REGISTRY_TIMEOUT},
+            # The chain ID never changes, so do not re-ask for it before every call.
+            cache_allowed_requests=True,
+            cacheable_requests={"eth_chainId"},
+        )
+        self.web3 = Web3(provider)
+
+        if not self.web3.is_connected():
+            raise ConnectionError("Failed to connect to the network")
+
+        with open("NodeRegistry.abi.json", "r") as abi_file:
+            abi = json.load(abi_file)
+
+        with open(config_path, "r") as json_file:
+            config = json.load(json_file)
+
+        self.contract = self.web3.eth.contract(address=config["nodeRegistry"], abi=abi)
+        self.cached_block = None
+        self.node_cache = {}
+
+    def block_number(self):
+        return self.web3.eth.block_number
+
+    def node_counts(self, block):
+        """
+        Total and canonical node counts at a block. Two small calls that tell
+        whether the indexed node list can still be trusted.
+        """
+        functions = self.contract.functions
+        return tuple(self.read_batch([functions.getAllNodesCount(), functions.canonicalNodesCount()], block))
 
-    return canonical_nodes
+    def get_all_nodes(self, block):
+        return self.contract.functions.getAllNodes().call(block_identifier=block)
 
-def check_grpc_status(address):
+    def read_batch(self, calls, block):
+        """
+        Runs contract calls pinned to one block as JSON-RPC batches of up to
+        REGISTRY_BATCH_SIZE calls each, and returns their results in order.
+        """
+        results = []
+        for start in range(0, len(calls), REGISTRY_BATCH_SIZE):
+            with self.web3.batch_requests() as batch:
+                for call in calls[start:start + REGISTRY_BATCH_SIZE]:
+                    batch.add(call.call(block_identifier=block))
+                results.extend(batch.execute())
+        return results
+
+    def get_nodes(self, node_ids, block):
+        """
+        getNode() for many nodes at one block, read in batches. Results are
+        cached for the latest block asked about, so repeated reads at the
+        same block cost nothing.
+        """
+        if block != self.cached_block:
+            self.cached_block = block
+            self.node_cache = {}
+
+        missing = [node_id for node_id in node_ids if node_id not in self.node_cache]
+        calls = [self.contract.functions.getNode(node_id) for node_id in missing]
+        self.node_cache.update(zip(missing, self.read_batch(calls, block)))
+        return {node_id: self.node_cache[node_id] for node_id in node_ids}
+
+    def get_logs(self, topics, from_block, to_block):
+        return self.web3.eth.get_logs({
+            "address": self.contract.address,
+            "fromBlock": from_block,
+            "toBlock": to_block,
+            "topics": [topics],
+        })
+
+def node_record(node):
     """
-    Function to check if the gRPC endpoint is reachable
-    by establishing a secure gRPC connection and calling the reflection API.
+    Converts a NodeRegistry Node struct into the indexer's node dict.
     """
-    version = "no version detected"
-    channel = None
+    signer, is_canonical, signing_public_key, http_address = node
+    return {
+        "signer": signer,
+        "isCanonical": is_canonical,
+        "signingPublicKey": "0x" + bytes(signing_public_key).hex(),
+        "httpAddress": http_address,
+    }
 
-    try:
-        # Create a secure gRPC channel with keepalive options.
-        options = [
-            ('grpc.keepalive_time_ms', 30000),
-            ('grpc.keepalive_timeout_ms', 5000),
-            ('grpc.keepalive_permit_without_calls', True),
-            ('grpc.http2.max_pings_without_data', 0),
-            ('grpc.http2.min_time_between_pings_ms', 10000),
-            ('grpc.http2.min_ping_interval_without_data_ms', 300000)
+class RegistryIndexer:
+    """
+    In-memory copy of the NodeRegistry kept current from contract logs.
+    The first sync seeds it with one getAllNodes() read at the latest block;
+    later syncs do nothing until the chain advances, then read only the new
+    logs. Nodes named in those logs are re-read in one batch at the synced
+    block. A full getAllNodes() reconcile runs when the on-chain node counts
+    disagree with the index, and otherwise every REGISTRY_RECONCILE_INTERVAL.
+    """
+
+    EVENTS = (
+        "NodeAdded",
+        "HttpAddressUpdated",
+        "NodeAddedToCanonicalNetwork",
+        "NodeRemovedFromCanonicalNetwork",
+    )
+
+    def __init__(self, client):
+        self.client = client
+        events = client.contract.events
+        self.events = {getattr(events, name)().topic: getattr(events, name)() for name in self.EVENTS}
+        # nodeId -> {"signer", "isCanonical", "signingPublicKey", "httpAddress"}
+        self.nodes = {}
+        self.last_block = None
+        self.last_reconcile = None
+
+    def sync(self):
+        latest = self.client.block_number()
+
+        if self.last_block is None:
+            self.reconcile(latest)
+            self.last_block = latest
+            return
+        elif latest > self.last_block:
+            changed = self.changed_nodes(self.last_block + 1, latest)
+        else:
+            return
+
+        if changed:
+            for node_id, node in self.client.get_nodes(sorted(changed), latest).items():
+                self.nodes[node_id] = node_record(node)
+        self.last_block = latest
+
+        indexed_counts = (len(self.nodes), sum(node["isCanonical"] for node in self.nodes.values()))
+        if (self.client.node_counts(latest) != indexed_counts
+                or time.monotonic() - self.last_reconcile > REGISTRY_RECONCILE_INTERVAL):
+            self.reconcile(latest)
+
+    def changed_nodes(self, from_block, to_block):
+        """
+        Fetches registry events in LOG_CHUNK_BLOCKS ranges and returns the
+        IDs of the nodes they touch.
+        """
+        changed = set()
+        for start in range(from_block, to_block + 1, LOG_CHUNK_BLOCKS):
+            logs = self.client.get_logs(list(self.events), start, min(start + LOG_CHUNK_BLOCKS - 1, to_block))
+            for log in logs:
+                event = self.events[log["topics"][0].to_0x_hex()].process_log(log)
+                changed.add(event["args"]["nodeId"])
+        return changed
+
+    def reconcile(self, block):
+        """
+        Replaces the indexed nodes with a full getAllNodes() read.
+        """
+        result = self.client.get_all_nodes(block)
+        self.nodes = {node_id: node_record(node) for node_id, node in result}
+        self.last_reconcile = time.monotonic()
+
+    def node_list(self):
+        return [dict(node, nodeId=node_id) for node_id, node in sorted(self.nodes.items())]
+
+    def canonical_addresses(self):
+        return [
+            node["httpAddress"].replace("https://", "") + ":443"
+            for node in self.nodes.values()
+            if node["isCanonical"] is True and node["httpAddress"]  # isCanonical and has httpAddress
         ]
 
-        channel = grpc.secure_channel(address, grpc.ssl_channel_credentials(), options=options)
+def provider_uri(network):
+    """
+    JSON-RPC endpoint for a network: WEB3_PROVIDER_URI_<NAME>, falling back
+    to WEB3_PROVIDER_URI.
+    """
+    return os.environ.get(f"WEB3_PROVIDER_URI_{network.upper()}") or os.environ["WEB3_PROVIDER_URI"]
+
+def get_addresses(network):
+    if network not in registries:
+        registries[network] = RegistryIndexer(RegistryClient(provider_uri(network), NETWORKS[network]))
+
+    registry = registries[network]
+    registry.sync()
+    registry_nodes[network] = registry.node_list()
+    return registry.canonical_addresses()
+
+async def connect_channel(channel):
+    """
+    Waits until the channel has either connected or failed to connect.
+    A channel that is already connected returns straight away.
+    """
+    state = channel.get_state(try_to_connect=True)
+    while state not in (grpc.ChannelConnectivity.READY,
+                        grpc.ChannelConnectivity.TRANSIENT_FAILURE,
+                        grpc.ChannelConnectivity.SHUTDOWN):
+        await channel.wait_for_state_change(state)
+        state = channel.get_state(try_to_connect=True)
+    return state
+
+async def get_channel(address, phases):
+    """
+    Returns the pooled channel for an address, creating it if needed, and
+    whether it had to (re)connect. Setup time is recorded into phases as
+    "dns" (new channels only) and "connect" (TCP, TLS and HTTP/2).
+    """
+    channel = channels.get(address)
+    if channel is not None and channel.get_state() == grpc.ChannelConnectivity.READY:
+        return channel, False
 
-        # Create a stub for reflection API
-        stub = reflection_pb2_grpc.ServerReflectionStub(channel)
-        request = reflection_pb2.ServerReflectionRequest(list_services="")
+    started = time.monotonic()
+    if channel is None:
+        host, port = address.rsplit(":", 1)
+        loop = asyncio.get_running_loop()
+        await asyncio.wait_for(loop.getaddrinfo(host, port, type=socket.SOCK_STREAM), timeout=CONNECT_TIMEOUT)
+        phases["dns"] = time.monotonic() - started
+        # The registry may have dropped the address during the lookup; a
+        # channel pooled now would never be closed.
+        if address not in node_states:
+            raise LookupError(f"{address} left the registry")
+        channel = grpc.aio.secure_channel(address, CHANNEL_CREDENTIALS, options=CHANNEL_OPTIONS)
+        channels[address] = channel
 
-        # Call the reflection API with timeout
-        response_iterator = stub.ServerReflectionInfo(iter([request]), timeout=5)
-        services = []
+    connect_started = time.monotonic()
+    state = await asyncio.wait_for(connect_channel(channel), timeout=CONNECT_TIMEOUT - (connect_started - started))
+    if state == grpc.ChannelConnectivity.READY:
+        phases["connect"] = time.monotonic() - connect_started
+    return channel, True
+
+async def close_channel(address):
+    """
+    Drops the pooled channel for an address so the next probe reconnects.
+    """
+    capabilities.pop(address, None)
+    channel = channels.pop(address, None)
+    if channel:
+        try:
+            await channel.close()
+        except Exception as e:
+            pass
+
+async def list_services(channel):
+    """
+    Lists the services a node exposes through the reflection API.
+    """
+    stub = reflection_pb2_grpc.ServerReflectionStub(channel)
+    request = reflection_pb2.ServerReflectionRequest(list_services="")
+
+    # Call the reflection API with timeout
+    response_iterator = stub.ServerReflectionInfo(iter([request]), timeout=REFLECTION_TIMEOUT)
+    services = []
+
+    async for resp in response_iterator:
+        if resp.HasField('list_services_response'):
+            services.extend([service.name for service in resp.list_services_response.service])
+
+    return services
+
+class NodeState:
+    """
+    One node's latest probe result. Records are never modified in place;
+    each probe replaces the node's record as a whole, so readers never see
+    a status paired with another probe's version or error.
+    """
+    __slots__ = ("status", "version", "error", "timings", "stale")
 
-        for resp in response_iterator:
-            if resp.HasField('list_services_response'):
-                services.extend([service.name for service in resp.list_services_response.service])
+    def __init__(self, status, version="", error="", timings=None, stale=False):
+        self.status = status
+        self.version = version
+        self.error = error
+        # Phase timings of the probe, in milliseconds.
+        self.timings = timings or {}
+        # Restored from the snapshot and not yet re-probed.
+        self.stale = stale
+
+class NodeHealth:
+    """
+    Debounced up/down state of one node. Each probe result updates streak
+    counters and a decaying flap score in constant time. Going down opens an
+    incident carrying the error of the first failure in the streak, and
+    coming back up closes it.
+    """
+    __slots__ = ("state", "failures", "successes", "cause", "last_up", "flap_score", "flap_updated", "incident")
+
+    def __init__(self):
+        self.state = "unknown"
+        self.failures = 0
+        self.successes = 0
+        self.cause = ""
+        self.last_up = None
+        self.flap_score = 0.0
+        self.flap_updated = 0.0
+        self.incident = None
+
+    def update(self, address, up, error, now):
+        """
+        Applies one probe result. Returns the new state when it changed,
+        except for a node's first result coming back up.
+        """
+        if self.last_up is not None and up != self.last_up:
+            self.flap_score = self.flap_score * 0.5 ** ((now - self.flap_updated) / FLAP_HALF_LIFE) + 1
+            self.flap_updated = now
+        self.last_up = up
+
+        if up:
+            self.successes += 1
+            self.failures = 0
+            if self.state == "unknown":
+                self.state = "up"
+            elif self.state == "down" and self.successes >= SUCCESSES_TO_UP:
+                return self.transition("up", now)
+        else:
+            if self.failures == 0:
+                self.cause = error
+            self.failures += 1
+            self.successes = 0
+            if self.state != "down" and self.failures >= FAILURES_TO_DOWN:
+                self.incident = {"address": address, "opened": now, "closed": None, "cause": self.cause}
+                incidents.append(self.incident)
+                return self.transition("down", now)
+        return None
+
+    def transition(self, state, now):
+        if state == "up" and self.incident is not None:
+            self.close(now)
+        self.state = state
+        return state
+
+    def close(self, now):
+        self.incident["closed"] = now
+        self.incident = None
+
+    def flapping(self, now):
+        return self.flap_score * 0.5 ** ((now - self.flap_updated) / FLAP_HALF_LIFE) > FLAP_THRESHOLD
+
+class LatencyWindow:
+    """
+    Ring buffer holding the most recent LATENCY_WINDOW samples of one phase,
+    so memory per node and phase stays fixed.
+    """
+    __slots__ = ("samples", "count")
+
+    def __init__(self):
+        self.samples = array("d", [0.0]) * LATENCY_WINDOW
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples[self.count % LATENCY_WINDOW] = seconds
+        self.count += 1
+
+    def percentiles(self):
+        """
+        Nearest-rank p50, p95 and p99 over the window, in milliseconds.
+        """
+        ordered = sorted(self.samples[:min(self.count, LATENCY_WINDOW)])
+        return {
+            f"p{q}": round(ordered[max(math.ceil(q / 100 * len(ordered)) - 1, 0)] * 1000, 1)
+            for q in (50, 95, 99)
+        }
+
+# Status codes stored in probe history.
+STATUS_DOWN = 0
+STATUS_UP = 1
+STATUS_TIMEOUT = 2
+
+def status_code(status):
+    if status == "✅ Reachable":
+        return STATUS_UP
+    if status == "⚠️ Timeout":
+        return STATUS_TIMEOUT
+    return STATUS_DOWN
+
+class ProbeHistory:
+    """
+    Ring buffer of a node's last HISTORY_SIZE probes, stored as packed
+    columns: wall-clock time, status code and per-phase latency in
+    milliseconds (NaN for phases the probe did not reach). Memory per node
+    is about 25 bytes per sample held, and the columns grow up to
+    HISTORY_SIZE only as probes come in.
+    """
+    __slots__ = ("times", "codes", "latencies", "count")
+
+    def __init__(self):
+        self.count = 0
+        self.resize(min(HISTORY_INITIAL_SIZE, HISTORY_SIZE))
+
+    def resize(self, size):
+        held = min(self.count, size)
+        codes = np.zeros(size, dtype=np.int8)
+        latencies = np.full((size, len(HISTORY_PHASES)), np.nan, dtype=np.float32)
+        times = np.zeros(size)
+        if held:
+            codes[:held] = self.codes[:held]
+            latencies[:held] = self.latencies[:held]
+            times[:held] = self.times[:held]
+        # Times are swapped in last, so a concurrent summary that sees the
+        # new times also sees the new codes and latencies.
+        self.codes = codes
+        self.latencies = latencies
+        self.times = times
+
+    def add(self, timestamp, status, timings):
+        size = len(self.times)
+        if self.count == size < HISTORY_SIZE:
+            size = min(2 * size, HISTORY_SIZE)
+            self.resize(size)
+        slot = self.count % size
+        self.codes[slot] = status_code(status)
+        self.latencies[slot] = [timings.get(phase, np.nan) for phase in HISTORY_PHASES]
+        # The time goes in last, so a concurrent summary never counts a slot
+        # whose other columns are still from the sample it replaces.
+        self.times[slot] = timestamp
+        self.count += 1
+
+    def summary(self, now):
+        """
+        Uptime and nearest-rank p50/p95/p99 of the total latency of
+        successful probes over each of HISTORY_WINDOWS, or None for a
+        window without probes.
+        """
+        times = self.times
+        filled = min(self.count, len(times))
+        times = times[:filled]
+        up = self.codes[:filled] == STATUS_UP
+        totals = np.nansum(self.latencies[:filled], axis=1)
+
+        summary = {}
+        for name, seconds in HISTORY_WINDOWS:
+            in_window = times >= now - seconds
+            probes = int(np.count_nonzero(in_window))
+            if not probes:
+                summary[name] = None
+                continue
+            window = {"probes": probes, "uptime": round(100 * np.count_nonzero(up & in_window) / probes, 2)}
+            reached = totals[up & in_window]
+            if reached.size:
+                p50, p95, p99 = np.percentile(reached, (50, 95, 99), method="inverted_cdf")
+                window.update(p50=round(float(p50), 1), p95=round(float(p95), 1), p99=round(float(p99), 1))
+            summary[name] = window
+        return summary
+
+def summarize_history():
+    global database_uptime, database_uptime_read
+    now = time.time()
+    summaries = {address: history.summary(now) for address, history in list(probe_history.items())}
+    if history_db is not None:
+        if time.monotonic() - database_uptime_read >= HISTORY_DB_INTERVAL:
+            database_uptime_read = time.monotonic()
+            database_uptime = {name: history_db.uptime(now - seconds) for name, seconds in HISTORY_DB_WINDOWS}
+        for name, uptime in database_uptime.items():
+            for address, summary in summaries.items():
+                summary[name] = uptime.get(address)
+    return summaries
+
+def sample_total_sql():
+    return " + ".join(f"IFNULL({phase}_ms, 0)" for phase in HISTORY_PHASES)
+
+class HistoryDatabase:
+    """
+    SQLite store of probe samples and their per-minute and per-hour
+    rollups. The database runs in WAL mode so reads do not block the
+    writer, and every call commits one transaction.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.executescript(f"""
+                CREATE TABLE IF NOT EXISTS samples (
+                    address TEXT NOT NULL,
+                    ts REAL NOT NULL,
+                    code INTEGER NOT NULL,
+                    {", ".join(f"{phase}_ms REAL" for phase in HISTORY_PHASES)}
+                );
+                CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts);
+                CREATE INDEX IF NOT EXISTS samples_address_ts ON samples (address, ts);
+                CREATE TABLE IF NOT EXISTS rollup_state (name TEXT PRIMARY KEY, until INTEGER NOT NULL);
+            """)
+            for table in ("minute_rollups", "hour_rollups"):
+                self.connection.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        address TEXT NOT NULL,
+                        start INTEGER NOT NULL,
+                        probes INTEGER NOT NULL,
+                        up INTEGER NOT NULL,
+                        latency_sum REAL,
+                        latency_min REAL,
+                        latency_max REAL,
+                        PRIMARY KEY (address, start)
+                    ) WITHOUT ROWID
+                """)
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_start ON {table} (start)")
+
+    def write(self, rows):
+        """
+        Inserts a batch of samples as (address, ts, code, *phase_ms).
+        """
+        placeholders = ", ".join("?" * (3 + len(HISTORY_PHASES)))
+        with self.lock, self.connection:
+            self.connection.executemany(f"INSERT INTO samples VALUES ({placeholders})", rows)
+
+    def rollup(self, now):
+        """
+        Aggregates the complete minutes and hours since the last rollup, then
+        prunes every table to its retention.
+        """
+        total = sample_total_sql()
+        minutes_until = int(now - ROLLUP_DELAY) // 60 * 60
+        with self.lock, self.connection:
+            minutes_from = self.rolled_until("minute_rollups", minutes_until - RAW_RETENTION)
+            self.connection.execute(f"""
+                INSERT INTO minute_rollups
+                SELECT address, CAST(ts / 60 AS INTEGER) * 60, COUNT(*), SUM(code = {STATUS_UP}),
+                       SUM(CASE WHEN code = {STATUS_UP} THEN {total} END),
+                       MIN(CASE WHEN code = {STATUS_UP} THEN {total} END),
+                       MAX(CASE WHEN code = {STATUS_UP} THEN {total} END)
+                FROM samples WHERE ts >= ? AND ts < ? GROUP BY 1, 2
+                ON CONFLICT (address, start) DO NOTHING
+            """, (minutes_from, minutes_until))
+            self.set_rolled_until("minute_rollups", minutes_until)
+
+            hours_until = minutes_until // 3600 * 3600
+            hours_from = self.rolled_until("hour_rollups", hours_until - MINUTE_RETENTION)
+            self.connection.execute("""
+                INSERT INTO hour_rollups
+                SELECT address, start / 3600 * 3600, SUM(probes), SUM(up),
+                       SUM(latency_sum), MIN(latency_min), MAX(latency_max)
+                FROM minute_rollups WHERE start >= ? AND start < ? GROUP BY 1, 2
+                ON CONFLICT (address, start) DO NOTHING
+            """, (hours_from, hours_until))
+            self.set_rolled_until("hour_rollups", hours_until)
+
+            self.connection.execute("DELETE FROM samples WHERE ts < ?", (now - RAW_RETENTION,))
+            self.connection.execute("DELETE FROM minute_rollups WHERE start < ?", (now - MINUTE_RETENTION,))
+            self.connection.execute("DELETE FROM hour_rollups WHERE start < ?", (now - HOUR_RETENTION,))
+
+    def uptime(self, since):
+        """
+        Probe count and uptime per node since the given time: whole hours
+        from the hour rollups, and the minutes not yet rolled into an hour
+        from the minute rollups. Both trail the raw samples by up to
+        ROLLUP_DELAY.
+        """
+        with self.lock:
+            hours_until = self.rolled_until("hour_rollups", 0)
+            rows = self.connection.execute("""
+                SELECT address, SUM(probes), SUM(up) FROM (
+                    SELECT address, probes, up FROM hour_rollups WHERE start >= ? AND start < ?
+                    UNION ALL
+                    SELECT address, probes, up FROM minute_rollups WHERE start >= ?
+                ) GROUP BY address
+            """, (since, hours_until, max(since, hours_until))).fetchall()
+        return {
+            address: {"probes": probes, "uptime": round(100 * up / probes, 2)}
+            for address, probes, up in rows if probes
+        }
+
+    def rolled_until(self, table, default):
+        row = self.connection.execute("SELECT until FROM rollup_state WHERE name = ?", (table,)).fetchone()
+        return row[0] if row else default
+
+    def set_rolled_until(self, table, until):
+        self.connection.execute("INSERT OR REPLACE INTO rollup_state VALUES (?, ?)", (table, until))
+
+class ProbeHistogram:
+    """
+    Cumulative Prometheus-style histogram over HISTOGRAM_BUCKETS.
+    """
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+# How long each batch of due probes took, from dispatch to its slowest probe.
+batch_durations = ProbeHistogram()
+
+def record_latencies(address, phases):
+    """
+    Stores the phase timings of one probe in the node's rolling latency
+    windows and in its metrics histograms. Probes that finish after their
+    address left the registry are not recorded.
+    """
+    if address not in node_states:
+        return
+    windows = latencies.setdefault(address, {})
+    histograms = probe_histograms.setdefault(address, {})
+    for phase, seconds in phases.items():
+        if phase not in windows:
+            windows[phase] = LatencyWindow()
+            histograms[phase] = ProbeHistogram()
+        windows[phase].add(seconds)
+        histograms[phase].observe(seconds)
+
+def latency_percentiles():
+    """
+    p50/p95/p99 per phase for every node, in milliseconds. Called from
+    request threads while the probe loop adds and removes nodes and phases,
+    so it iterates over copies.
+    """
+    return {
+        address: {phase: window.percentiles() for phase, window in list(windows.items())}
+        for address, windows in list(latencies.items())
+    }
+
+def get_capabilities(address, reconnected):
+    """
+    Returns the cached reflection results for an address, or None when there
+    are none, they are older than CAPABILITY_TTL or the channel reconnected.
+    """
+    cached = capabilities.get(address)
+    if cached and (reconnected or time.monotonic() - cached["fetched_at"] > CAPABILITY_TTL):
+        capabilities.pop(address, None)
+        return None
+    return cached
+
+async def check_grpc_status(address, phases):
+    """
+    Function to check if the gRPC endpoint is reachable over the node's
+    pooled channel. Nodes with cached capabilities are probed with a single
+    GetVersion call; otherwise the reflection API is walked first. Returns
+    (version, status, error) and fills in the phase timings.
+    """
+    version = "no version detected"
+    phase = "connect"
+
+    try:
+        channel, reconnected = await get_channel(address, phases)
+
+        cached = get_capabilities(address, reconnected)
+        if cached and has_metadata_service(cached["services"]):
+            phase = "version"
+            started = time.monotonic()
+            version = await fetch_version(channel)
+            phases["version"] = time.monotonic() - started
+            if version != cached["version"]:
+                capabilities.pop(address, None)
+            return version, "✅ Reachable", ""
+
+        phase = "reflection"
+        started = time.monotonic()
+        services = await list_services(channel)
+        phases["reflection"] = time.monotonic() - started
 
         # If response is received, mark as reachable
         if services:
-            errors[address] = ""  # Clear any previous errors
-            version = get_service_version(services, channel)
-            return address, version, "✅ Reachable"
+            phase = "version"
+            started = time.monotonic()
+            version = await get_service_version(services, channel)
+            if has_metadata_service(services):
+                phases["version"] = time.monotonic() - started
+            if address in node_states:
+                capabilities[address] = {"services": services, "version": version, "fetched_at": time.monotonic()}
+            return version, "✅ Reachable", ""
 
         else:
-            errors[address] = "No response from server"
-            return address, version, "❌ No Response"
+            return version, "❌ No Response", "No response from server"
 
     except grpc.RpcError as e:
+        await close_channel(address)
+        if e.code() == grpc.StatusCode.DEADLINE_EXCEEDED:
+            return version, "⚠️ Timeout", f"{phase} deadline exceeded"
         error_message = f"gRPC Error: {e.code().name} - {str(e.details())}"
-        errors[address] = error_message
-        return address, version, f"❌ Error: {e.code().name}"
+        return version, f"❌ Error: {e.code().name}", error_message
+
+    except asyncio.TimeoutError:
+        await close_channel(address)
+        return version, "⚠️ Timeout", f"{phase} deadline exceeded"
+
+    except socket.gaierror as e:
+        await close_channel(address)
+        return version, "❌ Error: DNS", f"DNS Error: {str(e)}"
 
     except Exception as e:
+        await close_channel(address)
         error_message = f"Exception: {str(e)}"
-        errors[address] = error_message
-        return address, version, "⚠️ Exception"
+        return version, "⚠️ Exception", error_message
 
     finally:
-        if channel:
-            try:
-                channel.close()
-            except Exception as e:
-                pass
+        record_latencies(address, phases)
+
+def has_metadata_service(services):
+    """
+    Whether the MetadataApi service is among the listed services.
+    """
+    return any(METADATA_SERVICE in service for service in services)
+
+async def fetch_version(channel):
+    """
+    Calls MetadataApi.GetVersion. RPC errors are left to the caller.
+    """
+    stub = metadata_api_pb2_grpc.MetadataApiStub(channel)
+    response = await stub.GetVersion(metadata_api_pb2.GetVersionRequest(), timeout=VERSION_TIMEOUT)
+    return response.version or "no version detected"
 
-def get_service_version(services, channel):
+async def get_service_version(services, channel):
     """
     Try to get version information from MetadataApi service
     """
     version = "no version detected"
 
     # Look for the MetadataApi service specifically
-    metadata_service = None
-    for service in services:
-        if 'xmtp.xmtpv4.metadata_api.MetadataApi' in service:
-            metadata_service = service
-            break
-
-    if not metadata_service:
+    if not has_metadata_service(services):
         return version
 
     try:
-        # Import the generated stubs
-        import proto.xmtpv4.metadata_api.metadata_api_pb2 as metadata_api_pb2
-        import proto.xmtpv4.metadata_api.metadata_api_pb2_grpc as metadata_api_pb2_grpc
+        return await fetch_version(channel)
 
-        # Create the MetadataApi stub
-        stub = metadata_api_pb2_grpc.MetadataApiStub(channel)
+    except grpc.RpcError as e:
+        return version
+    except Exception as e:
+        return version
+
+class ProbeScheduler:
+    """
+    Priority queue of per-node next-due times. Healthy nodes are probed every
+    PROBE_INTERVAL, nodes that just changed state are re-probed quickly, and
+    nodes that stay down back off exponentially up to MAX_PROBE_INTERVAL.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.due = {}
+        self.failures = {}
+        self.wakeup = asyncio.Event()
+
+    def add(self, address):
+        self.failures[address] = 0
+        self.schedule(address, 0)
+
+    def remove(self, address):
+        # Heap entries for removed addresses are skipped when popped.
+        self.due.pop(address, None)
+        self.failures.pop(address, None)
+
+    def schedule(self, address, delay):
+        due = time.monotonic() + delay
+        self.due[address] = due
+        heapq.heappush(self.heap, (due, address))
+        self.wakeup.set()
+
+    def pop_due(self):
+        """
+        Removes and returns every address whose probe is due.
+        """
+        now = time.monotonic()
+        ready = []
+        while self.heap and self.heap[0][0] <= now:
+            due, address = heapq.heappop(self.heap)
+            if self.due.get(address) == due:
+                del self.due[address]
+                ready.append(address)
+        return ready
 
-        # Create the GetVersion request
-        request = metadata_api_pb2.GetVersionRequest()
+    def next_delay(self):
+        """
+        Seconds until the next live entry is due, or None if there is none.
+        """
+        while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return max(self.heap[0][0] - time.monotonic(), 0)
 
-        # Call GetVersion.
-        response = stub.GetVersion(request, timeout=3)
+    def record(self, address, previous_status, status):
+        """
+        Schedules the next probe of an address from its latest result.
+        """
+        if address not in self.failures:
+            return
 
-        # Return the actual version string
-        if response.version:
-            return response.version
+        if status == "✅ Reachable":
+            self.failures[address] = 0
         else:
-            return version
+            self.failures[address] += 1
 
-    except grpc.RpcError as e:
-        return version
-    except ImportError as e:
-        return version
+        if previous_status not in ("Checking...", status):
+            interval = FAST_REPROBE_INTERVAL
+        elif self.failures[address] > FAILURES_BEFORE_BACKOFF:
+            backoff = 2 ** (self.failures[address] - FAILURES_BEFORE_BACKOFF)
+            interval = min(PROBE_INTERVAL * backoff, MAX_PROBE_INTERVAL)
+        else:
+            interval = PROBE_INTERVAL
+
+        self.schedule(address, interval * random.uniform(1 - PROBE_JITTER, 1 + PROBE_JITTER))
+
+def record_result(scheduler, address, state):
+    """
+    Stores a probe result and schedules the address's next probe. Results
+    for addresses that left the registry while in flight are dropped.
+    """
+    previous = node_states.get(address)
+    if previous is None:
+        return
+    global state_changed
+    node_states[address] = state
+    now = time.time()
+    if address not in node_health:
+        node_health[address] = NodeHealth()
+    transition = node_health[address].update(address, state.status == "✅ Reachable", state.error, now)
+    if transition:
+        enqueue_alert(address, transition, node_health[address].cause, now)
+    if address not in probe_history:
+        probe_history[address] = ProbeHistory()
+    probe_history[address].add(now, state.status, state.timings)
+    if history_db is not None:
+        pending_samples.append(
+            (address, now, status_code(state.status), *(state.timings.get(phase) for phase in HISTORY_PHASES))
+        )
+        if len(pending_samples) >= HISTORY_FLUSH_ROWS:
+            history_flush.set()
+    if AGGREGATOR_URL or AGGREGATE:
+        code = status_code(state.status)
+        result = (code, round(sum(state.timings.values()), 1) if code == STATUS_UP else None, now)
+        if AGGREGATOR_URL:
+            outbound_results[address] = result
+        if AGGREGATE:
+            with vantage_lock:
+                vantage_results.setdefault(address, {})[VANTAGE] = (*result, now)
+    state_changed = True
+    scheduler.record(address, previous.status, state.status)
+
+async def probe_node(semaphore, scheduler, address):
+    """
+    Probes one address once a slot in the in-flight limit is free and records
+    the result as soon as it is in. Each probe phase has its own deadline,
+    so a hung node gives up its slot after at most the sum of them.
+    """
+    phases = {}
+    async with semaphore:
+        try:
+            version, status, error = await check_grpc_status(address, phases)
+        except Exception as e:
+            previous = node_states.get(address)
+            version = previous.version if previous else ""
+            status = "⚠️ Processing Error"
+            error = str(e)
+    timings = {phase: round(seconds * 1000, 1) for phase, seconds in phases.items()}
+    record_result(scheduler, address, NodeState(status, version, error, timings))
+
+async def probe_batch(semaphore, scheduler, batch):
+    """
+    Probes a batch of due addresses concurrently, then marks the metrics
+    stale.
+    """
+    global metrics_changed
+    started = time.monotonic()
+    await asyncio.gather(*(probe_node(semaphore, scheduler, addr) for addr in batch))
+    batch_durations.observe(time.monotonic() - started)
+    metrics_changed = True
+
+    if time.monotonic() - sweep_stats["snapshot_written"] >= SNAPSHOT_INTERVAL:
+        sweep_stats["snapshot_written"] = time.monotonic()
+        try:
+            await asyncio.to_thread(write_snapshot, snapshot_payload())
+        except Exception as e:
+            print(f"Error writing snapshot: {e}")
+
+def snapshot_payload():
+    """
+    Registry view and latest probe results, as persisted for warm starts.
+    """
+    return {
+        "written_at": time.time(),
+        "networks": {network: sorted(nodes) for network, nodes in network_addresses.items()},
+        "registry": registry_nodes,
+        "nodes": {
+            address: [state.status, state.version, state.error, state.timings]
+            for address, state in node_states.items()
+        },
+    }
+
+def write_atomically(path, data):
+    """
+    Writes data to a temporary file next to path and renames it into place,
+    so a crash never leaves a partial file behind and readers always see a
+    complete one.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".snapshot-")
+    try:
+        with os.fdopen(fd, "wb") as target:
+            target.write(data)
+            target.flush()
+            os.fsync(target.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+def write_snapshot(payload):
+    """
+    Writes the warm-start snapshot to SNAPSHOT_PATH.
+    """
+    write_atomically(SNAPSHOT_PATH, gzip.compress(json.dumps(payload, separators=(",", ":")).encode()))
+
+def load_snapshot():
+    """
+    Restores the last snapshot, if any, so the server has data to serve
+    before the first registry sync and probes finish. Restored nodes are
+    marked stale until they are probed again.
+    """
+    try:
+        with open(SNAPSHOT_PATH, "rb") as snapshot_file:
+            payload = json.loads(gzip.decompress(snapshot_file.read()))
+    except FileNotFoundError:
+        return
     except Exception as e:
-        return version
+        print(f"Error loading snapshot: {e}")
+        return
 
-def update_status():
+    for network, nodes in payload["networks"].items():
+        if network in NETWORKS:
+            network_addresses[network] = set(nodes)
+            registry_nodes[network] = payload["registry"].get(network, [])
+
+    global node_states, state_changed
+    restored = set().union(*network_addresses.values())
+    node_states = {
+        address: NodeState(status, version, error, timing, stale=True)
+        for address, (status, version, error, timing) in payload["nodes"].items()
+        if address in restored
+    }
+    # Have the publish loop share the restored view right away, before any
+    # probe or registry result comes in.
+    state_changed = True
+
+async def sync_network(network):
     """
-    Runs gRPC checks in parallel for all addresses using ThreadPoolExecutor
-    and updates the list of addresses dynamically.
+    Syncs one network's registry. On failure the network keeps the
+    addresses from its last successful sync.
     """
-    global addresses, errors
+    try:
+        started = time.monotonic()
+        network_addresses[network] = set(await asyncio.to_thread(get_addresses, network))
+        sweep_stats["registry_sync_seconds"][network] = time.monotonic() - started
+    except Exception as e:
+        print(f"Error updating {network} registry: {e}")
+
+async def registry_loop(scheduler):
+    """
+    Refreshes every network's registry concurrently every REGISTRY_INTERVAL
+    and adds or removes addresses from the shared scheduler.
+    """
+    global state_changed, node_states
 
     while True:
         try:
-            new_addresses = set(get_addresses())
+            await asyncio.gather(*(sync_network(network) for network in NETWORKS))
+            new_addresses = set().union(*network_addresses.values())
 
             # Identify added and removed addresses
-            current_addresses = set(addresses.keys())
+            current_addresses = set(node_states.keys())
             added_addresses = new_addresses - current_addresses
             removed_addresses = current_addresses - new_addresses
 
-            # Remove old addresses
+            # Swap in the new node set, with a default status for new
+            # addresses; the records of removed ones go with the old dict.
+            if added_addresses or removed_addresses:
+                updated = {addr: state for addr, state in node_states.items() if addr in new_addresses}
+                for addr in added_addresses:
+                    updated[addr] = NodeState("Checking...")
+                node_states = updated
+
             for addr in removed_addresses:
-                addresses.pop(addr, None)
-                errors.pop(addr, None)
+                latencies.pop(addr, None)
+                probe_histograms.pop(addr, None)
+                probe_history.pop(addr, None)
+                alerted_states.pop(addr, None)
+                outbound_results.pop(addr, None)
+                with vantage_lock:
+                    vantage_results.pop(addr, None)
+                health = node_health.pop(addr, None)
+                if health and health.incident is not None:
+                    health.close(time.time())
+                scheduler.remove(addr)
+                await close_channel(addr)
 
-            # Add new addresses with a default status
             for addr in added_addresses:
-                addresses[addr] = "Checking..."
-
-            future_to_address = {executor.submit(check_grpc_status, addr): addr for addr in addresses.keys()}
-
-            # Wait for all futures to complete with a timeout
-            for future in concurrent.futures.as_completed(future_to_address, timeout=15):
-                try:
-                    address, version, status = future.result()
-                    addresses[address] = status
-                    versions[address] = version
-                except Exception as e:
-                    addr = future_to_address[future]
-                    addresses[addr] = "⚠️ Processing Error"
-                    errors[addr] = str(e)
-
-            # Cancel any remaining futures
-            for future in future_to_address:
-                if not future.done():
-                    future.cancel()
-
-        except concurrent.futures.TimeoutError:
-            # Mark timed out addresses
-            for future, addr in future_to_address.items():
-                if not future.done():
-                    addresses[addr] = "⚠️ Timeout"
-                    errors[addr] = "Check timed out"
-                    future.cancel()
+                scheduler.add(addr)
+
+            state_changed = True
+
         except Exception as e:
             print(f"Error updating status: {e}")
 
-        time.sleep(15)
+        await asyncio.sleep(REGISTRY_INTERVAL)
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def histogram_lines(name, labels, histogram):
+    """
+    Exposition lines of one histogram: cumulative buckets, sum and count.
+    """
+    separator, label_set = (",", f"{{{labels}}}") if labels else ("", "")
+    lines = []
+    cumulative = 0
+    for bound, count in zip(HISTOGRAM_BUCKETS + ("+Inf",), histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+    lines.append(f"{name}_sum{label_set} {histogram.sum}")
+    lines.append(f"{name}_count{label_set} {cumulative}")
+    return lines
+
+def render_metrics():
+    """
+    Rebuilds the Prometheus text exposition served by /metrics. Runs on the
+    probe loop at most every METRICS_INTERVAL, so scrapes only copy out the
+    cached body.
+    """
+    states = node_states
+    nodes = [
+        (network, address)
+        for network, network_nodes in network_addresses.items()
+        for address in sorted(network_nodes)
+        if address in states
+    ]
+    lines = [
+        "# HELP xmtp_node_up Whether the node answered its last probe.",
+        "# TYPE xmtp_node_up gauge",
+    ]
+    for network, address in nodes:
+        up = int(states[address].status == "✅ Reachable")
+        lines.append(f'xmtp_node_up{{network="{escape_label(network)}",address="{escape_label(address)}"}} {up}')
 
-# Start gRPC checking in a separate thread.
-threading.Thread(target=update_status, daemon=True).start()
+    lines += [
+        "# HELP xmtp_node_version_info Version reported by the node's MetadataApi.",
+        "# TYPE xmtp_node_version_info gauge",
+    ]
+    for network, address in nodes:
+        labels = f'network="{escape_label(network)}",address="{escape_label(address)}"'
+        lines.append(f'xmtp_node_version_info{{{labels},version="{escape_label(states[address].version)}"}} 1')
+
+    lines += [
+        "# HELP xmtp_probe_duration_seconds Probe latency per phase.",
+        "# TYPE xmtp_probe_duration_seconds histogram",
+    ]
+    for address, histograms in probe_histograms.items():
+        for phase, histogram in histograms.items():
+            lines += histogram_lines("xmtp_probe_duration_seconds", f'address="{escape_label(address)}",phase="{phase}"', histogram)
+
+    lines += [
+        "# HELP xmtp_node_replication_lag Largest sequence ID gap to the newest known cursor of any originator.",
+        "# TYPE xmtp_node_replication_lag gauge",
+    ]
+    for address, lag in replication_lag.items():
+        lines.append(f'xmtp_node_replication_lag{{address="{escape_label(address)}"}} {lag["max"]}')
+
+    lines += [
+        "# HELP xmtp_registry_sync_duration_seconds Duration of the last registry sync.",
+        "# TYPE xmtp_registry_sync_duration_seconds gauge",
+    ]
+    for network, seconds in sweep_stats["registry_sync_seconds"].items():
+        lines.append(f'xmtp_registry_sync_duration_seconds{{network="{escape_label(network)}"}} {seconds}')
+
+    # Nodes are probed as they fall due rather than in sweeps, so a batch is
+    # whatever came due together, often a single node.
+    lines += [
+        "# HELP xmtp_probe_batch_duration_seconds Time from dispatching a batch of due probes to its slowest probe.",
+        "# TYPE xmtp_probe_batch_duration_seconds histogram",
+    ]
+    lines += histogram_lines("xmtp_probe_batch_duration_seconds", "", batch_durations)
+
+    global metrics_body
+    metrics_body = ("\n".join(lines) + "\n").encode()
+
+def metadata_channel(address):
+    """
+    Returns the node's pooled channel if it is connected and the node is
+    known to serve the MetadataApi, otherwise None.
+    """
+    channel = channels.get(address)
+    cached = capabilities.get(address)
+    if channel is None or channel.get_state() != grpc.ChannelConnectivity.READY:
+        return None
+    if not cached or not has_metadata_service(cached["services"]):
+        return None
+    return channel
+
+async def fetch_sync_cursor(semaphore, address):
+    """
+    Reads a node's sync cursor over its live pooled channel. Returns None for
+    nodes without a connected channel or without the MetadataApi.
+    """
+    channel = metadata_channel(address)
+    if channel is None:
+        return None
+
+    async with semaphore:
+        try:
+            stub = metadata_api_pb2_grpc.MetadataApiStub(channel)
+            response = await stub.GetSyncCursor(metadata_api_pb2.GetSyncCursorRequest(), timeout=CURSOR_TIMEOUT)
+        except grpc.RpcError as e:
+            return None
+    return dict(response.latest_sync.node_id_to_sequence_id)
+
+def compute_replication_lag():
+    """
+    Builds each network's node x originator lag matrix from the collected
+    cursors and the per-node summary, both served at /lag, and swaps them
+    in whole so readers never see a half-built one.
+    """
+    global lag_matrix, replication_lag, extra_changed, metrics_changed
+    matrices = {}
+    summaries = {}
+    for network, network_nodes in network_addresses.items():
+        matrices[network], summary = network_replication_lag(sorted(network_nodes))
+        summaries.update(summary)
+
+    lag_matrix = matrices
+    replication_lag = summaries
+    extra_changed = metrics_changed = True
+
+def network_replication_lag(network_nodes):
+    """
+    Lag matrix for one network: how far each node's sequence ID trails the
+    highest one known for every originator, plus a per-node summary.
+    """
+    nodes = [address for address in network_nodes if address in sync_cursors]
+    originators = sorted({originator for address in nodes for originator in sync_cursors[address]})
+    column = {originator: i for i, originator in enumerate(originators)}
+
+    cursors = np.zeros((len(nodes), len(originators)), dtype=np.uint64)
+    for row, address in enumerate(nodes):
+        cursor = sync_cursors[address]
+        if cursor:
+            cursors[row, [column[originator] for originator in cursor]] = list(cursor.values())
+
+    # An originator missing from a node's cursor counts as sequence ID 0.
+    lag = (cursors.max(axis=0, initial=0) - cursors) if nodes else cursors
+    max_lag = lag.max(axis=1, initial=0)
+    total_lag = lag.sum(axis=1)
+
+    summary = {
+        address: {"max": int(max_lag[row]), "total": int(total_lag[row]), "stream": cursor_stream_states.get(address)}
+        for row, address in enumerate(nodes)
+    }
+    return {"nodes": nodes, "originators": originators, "lag": lag.tolist(), "summary": summary}, summary
+
+async def watch_sync_cursor(address):
+    """
+    Holds a SubscribeSyncCursor stream open to one node and stores every
+    cursor it pushes. Reconnects with exponential backoff, and treats a
+    stream that has been quiet for STREAM_STALL_TIMEOUT as stalled.
+    """
+    global cursors_changed
+    backoff = STREAM_MIN_BACKOFF
+
+    while address in node_states:
+        channel = metadata_channel(address)
+        if channel is None:
+            cursor_stream_states[address] = "reconnecting"
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, STREAM_MAX_BACKOFF)
+            continue
+
+        stub = metadata_api_pb2_grpc.MetadataApiStub(channel)
+        call = stub.SubscribeSyncCursor(metadata_api_pb2.GetSyncCursorRequest())
+        try:
+            while True:
+                response = await asyncio.wait_for(call.read(), timeout=STREAM_STALL_TIMEOUT)
+                if response is grpc.aio.EOF:
+                    cursor_stream_states[address] = "reconnecting"
+                    break
+                sync_cursors[address] = dict(response.latest_sync.node_id_to_sequence_id)
+                cursor_stream_states[address] = "live"
+                cursors_changed = True
+                backoff = STREAM_MIN_BACKOFF
+
+        except asyncio.TimeoutError:
+            cursor_stream_states[address] = "stalled"
+        except grpc.RpcError as e:
+            cursor_stream_states[address] = "reconnecting"
+        finally:
+            call.cancel()
+
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, STREAM_MAX_BACKOFF)
+
+async def poll_sync_cursors(semaphore):
+    """
+    Fallback for nodes without a live stream: reads their cursors with
+    GetSyncCursor and drops the cursors of nodes that cannot be reached.
+    """
+    global cursors_changed
+    targets = [addr for addr in node_states if cursor_stream_states.get(addr) != "live"]
+    results = await asyncio.gather(*(fetch_sync_cursor(semaphore, addr) for addr in targets))
+    for addr, cursor in zip(targets, results):
+        if cursor is None:
+            sync_cursors.pop(addr, None)
+        else:
+            sync_cursors[addr] = cursor
+    cursors_changed = True
+
+async def cursor_loop(semaphore):
+    """
+    Keeps one cursor stream per registry node, polls the nodes whose stream
+    is down every SYNC_CURSOR_INTERVAL, and recomputes replication lag at
+    most once per LAG_INTERVAL when any cursor changed.
+    """
+    global cursors_changed
+    streams = {}
+    last_poll = time.monotonic()
+
+    while True:
+        await asyncio.sleep(LAG_INTERVAL)
+        try:
+            for addr in node_states:
+                if addr not in streams:
+                    streams[addr] = asyncio.ensure_future(watch_sync_cursor(addr))
+            for addr in list(streams):
+                if addr not in node_states or streams[addr].done():
+                    streams.pop(addr).cancel()
+                    sync_cursors.pop(addr, None)
+                    cursor_stream_states.pop(addr, None)
+                    cursors_changed = True
+
+            if time.monotonic() - last_poll >= SYNC_CURSOR_INTERVAL:
+                last_poll = time.monotonic()
+                await poll_sync_cursors(semaphore)
+
+            if cursors_changed:
+                cursors_changed = False
+                compute_replication_lag()
+        except Exception as e:
+            print(f"Error updating sync cursors: {e}")
+
+async def history_loop():
+    """
+    Recomputes every node's uptime and latency summary each
+    HISTORY_SUMMARY_INTERVAL, off the event loop.
+    """
+    global history_summaries, state_changed
+
+    while True:
+        await asyncio.sleep(HISTORY_SUMMARY_INTERVAL)
+        try:
+            history_summaries = await asyncio.to_thread(summarize_history)
+            if AGGREGATE:
+                prune_vantage_results(time.time())
+            state_changed = True
+        except Exception as e:
+            print(f"Error summarizing history: {e}")
+
+def query_history(connection, address, start, end, step):
+    """
+    Downsamples a node's history between start and end into buckets of step
+    seconds, inside SQLite. Reads the finest table whose retention still
+    covers start. Each bucket keeps the probe count, the uptime and the
+    min, mean and max latency of successful probes, so short outages and
+    latency spikes survive the downsampling.
+    """
+    age = time.time() - start
+    if age <= RAW_RETENTION:
+        total = sample_total_sql()
+        source, sql = "raw", f"""
+            SELECT CAST((ts - ?) / ? AS INTEGER), COUNT(*), SUM(code = {STATUS_UP}),
+                   MIN(CASE WHEN code = {STATUS_UP} THEN {total} END),
+                   SUM(CASE WHEN code = {STATUS_UP} THEN {total} END),
+                   MAX(CASE WHEN code = {STATUS_UP} THEN {total} END)
+            FROM samples WHERE address = ? AND ts >= ? AND ts < ? GROUP BY 1 ORDER BY 1
+        """
+    else:
+        table = "minute_rollups" if age <= MINUTE_RETENTION else "hour_rollups"
+        source, sql = table.split("_")[0], f"""
+            SELECT CAST((start - ?) / ? AS INTEGER), SUM(probes), SUM(up),
+                   MIN(latency_min), SUM(latency_sum), MAX(latency_max)
+            FROM {table} WHERE address = ? AND start >= ? AND start < ? GROUP BY 1 ORDER BY 1
+        """
+    return source, connection.execute(sql, (start, step, address, start, end))
+
+def history_chunks(connection, cursor, header, start, step):
+    """
+    Streams the JSON response a batch of buckets at a time.
+    """
+    try:
+        yield header
+        separator = b""
+        while True:
+            rows = cursor.fetchmany(500)
+            if not rows:
+                break
+            points = []
+            for bucket, probes, up, latency_min, latency_sum, latency_max in rows:
+                points.append(json.dumps({
+                    "t": start + bucket * step,
+                    "probes": probes,
+                    "uptime": round(100 * up / probes, 2),
+                    "latency_min": round(latency_min, 1) if up else None,
+                    "latency_mean": round(latency_sum / up, 1) if up else None,
+                    "latency_max": round(latency_max, 1) if up else None,
+                }, separators=(",", ":")).encode())
+            yield separator + b",".join(points)
+            separator = b","
+        yield b"]}"
+    finally:
+        connection.close()
+
+async def history_writer_loop():
+    """
+    Writes pending probe samples to the history database in one transaction
+    every HISTORY_FLUSH_INTERVAL, or as soon as HISTORY_FLUSH_ROWS pile up.
+    """
+    global pending_samples
+    while True:
+        try:
+            await asyncio.wait_for(history_flush.wait(), timeout=HISTORY_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        history_flush.clear()
+        rows, pending_samples = pending_samples, []
+        if not rows:
+            continue
+        try:
+            await asyncio.to_thread(history_db.write, rows)
+        except Exception as e:
+            print(f"Error writing history: {e}")
+
+async def rollup_loop():
+    """
+    Rolls raw samples up into minute and hour aggregates every
+    ROLLUP_INTERVAL, off the event loop.
+    """
+    while True:
+        await asyncio.sleep(ROLLUP_INTERVAL)
+        try:
+            await asyncio.to_thread(history_db.rollup, time.time())
+        except Exception as e:
+            print(f"Error rolling up history: {e}")
+
+def enqueue_alert(address, state, cause, now):
+    """
+    Queues a health transition for alerting without ever waiting; when the
+    queue is full the transition is dropped.
+    """
+    if alert_queue is None:
+        return
+    alert = {
+        "address": address,
+        "networks": sorted(network for network, nodes in network_addresses.items() if address in nodes),
+        "state": state,
+        "cause": cause if state == "down" else "",
+        "at": now,
+    }
+    try:
+        alert_queue.put_nowait(alert)
+    except asyncio.QueueFull:
+        print(f"Alert queue full, dropping {state} alert for {address}")
+
+def alert_payload(alerts):
+    """
+    One notification for a group of transitions. "text" is what chat
+    webhooks display; "alerts" carries the details.
+    """
+    down = [alert for alert in alerts if alert["state"] == "down"]
+    up = [alert for alert in alerts if alert["state"] == "up"]
+    lines = []
+    if down:
+        lines.append(f"🔴 {len(down)} node(s) down:")
+        lines += [f"• {alert['address']}: {alert['cause']}" for alert in down]
+    if up:
+        lines.append(f"🟢 {len(up)} node(s) recovered:")
+        lines += [f"• {alert['address']}" for alert in up]
+    return {"text": "\n".join(lines), "alerts": alerts}
+
+class AlertSink:
+    """
+    One alert destination. Notifications that arrive while it is rate
+    limited or retrying are merged into its next delivery, so a slow or
+    failing destination never holds up the others.
+    """
+    def __init__(self, target):
+        self.target = target
+        self.pending = []
+        self.ready = asyncio.Event()
+        self.last_sent = -ALERT_MIN_INTERVAL
+
+    def submit(self, alerts):
+        self.pending = (self.pending + alerts)[-ALERT_QUEUE_SIZE:]
+        self.ready.set()
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            await asyncio.sleep(max(self.last_sent + ALERT_MIN_INTERVAL - time.monotonic(), 0))
+            self.ready.clear()
+            alerts, self.pending = self.pending, []
+            await self.deliver(alert_payload(alerts))
+            self.last_sent = time.monotonic()
+
+    async def deliver(self, payload):
+        for attempt in range(ALERT_RETRIES):
+            try:
+                await asyncio.to_thread(self.send, payload)
+                return
+            except Exception as e:
+                print(f"Error sending alert to {self.target}: {e}")
+                await asyncio.sleep(min(ALERT_MIN_BACKOFF * 2 ** attempt, ALERT_MAX_BACKOFF))
+        print(f"Giving up on alert to {self.target} after {ALERT_RETRIES} attempts")
+
+    def send(self, payload):
+        if self.target == "stdout":
+            print(payload["text"], flush=True)
+            return
+        response = requests.post(self.target, json=payload, timeout=ALERT_TIMEOUT)
+        response.raise_for_status()
+
+async def alert_loop(sinks):
+    """
+    Groups the transitions queued within ALERT_GROUP_WINDOW of each other,
+    keeps each node's latest one, drops those that repeat the state the
+    node was last alerted as, and hands the rest to every sink.
+    """
+    while True:
+        alerts = [await alert_queue.get()]
+        await asyncio.sleep(ALERT_GROUP_WINDOW)
+        while not alert_queue.empty():
+            alerts.append(alert_queue.get_nowait())
+
+        latest = {alert["address"]: alert for alert in alerts}
+        fresh = [alert for address, alert in latest.items() if alerted_states.get(address, "up") != alert["state"]]
+        for alert in fresh:
+            alerted_states[alert["address"]] = alert["state"]
+        if fresh:
+            for sink in sinks:
+                sink.submit(fresh)
+
+def push_results(session, results):
+    """
+    Sends one compact batch to the aggregator: [address, status code,
+    latency ms, age s] per node, gzipped. Ages rather than timestamps keep
+    the aggregator independent of this host's clock.
+    """
+    now = time.time()
+    batch = {
+        "vantage": VANTAGE,
+        "results": [[address, code, latency, round(now - at, 1)] for address, (code, latency, at) in results.items()],
+    }
+    headers = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+    if INGEST_TOKEN:
+        headers["Authorization"] = f"Bearer {INGEST_TOKEN}"
+    body = gzip.compress(json.dumps(batch, separators=(",", ":")).encode())
+    response = session.post(AGGREGATOR_URL, data=body, headers=headers, timeout=PUSH_TIMEOUT)
+    response.raise_for_status()
+
+async def push_loop():
+    """
+    Pushes every node's latest result each PUSH_INTERVAL. Each push doubles
+    as a heartbeat for this vantage, and a failed push is simply covered by
+    the next one.
+    """
+    session = requests.Session()
+
+    while True:
+        await asyncio.sleep(PUSH_INTERVAL)
+        results = dict(outbound_results)
+        if not results:
+            continue
+        try:
+            await asyncio.to_thread(push_results, session, results)
+        except Exception as e:
+            print(f"Error pushing results to aggregator: {e}")
+
+def store_vantage_results(vantage, results):
+    """
+    Records (address, status code, latency ms, probed at, heard at) reports
+    from another vantage. Only nodes in this aggregator's registry are kept,
+    which bounds memory to nodes x vantages. Returns how many were kept.
+    """
+    global state_changed
+    states = node_states
+    accepted = 0
+    with vantage_lock:
+        for address, code, latency, at, heard in results:
+            if address in states:
+                vantage_results.setdefault(address, {})[vantage] = (code, latency, at, heard)
+                accepted += 1
+    state_changed = True
+    return accepted
+
+def prune_vantage_results(now):
+    """
+    Drops reports from vantages not heard from within VANTAGE_RETENTION,
+    so vantages that went away stop taking memory and showing up in
+    /vantages.
+    """
+    with vantage_lock:
+        for address, by_vantage in list(vantage_results.items()):
+            for vantage, report in list(by_vantage.items()):
+                if vantage != VANTAGE and now - report[3] > VANTAGE_RETENTION:
+                    del by_vantage[vantage]
+            if not by_vantage:
+                del vantage_results[address]
+
+def ingested_result(address, code, latency, age):
+    """
+    Validates one [address, status code, latency ms, age s] entry of an
+    ingested batch; latency is None for failed probes.
+    """
+    if latency is not None:
+        latency = float(latency)
+        if not math.isfinite(latency):
+            raise ValueError(f"latency {latency} is not finite")
+    age = float(age)
+    if not (math.isfinite(age) and age >= 0):
+        raise ValueError(f"age {age} is not a finite, non-negative number")
+    return str(address), int(code), latency, age
+
+def drain_ingest_spool():
+    """
+    Applies the batches web workers spooled, oldest first, and removes
+    them. Files still being written start with a dot and wait for the next
+    pass.
+    """
+    for name in sorted(os.listdir(INGEST_SPOOL_PATH)):
+        if name.startswith("."):
+            continue
+        path = os.path.join(INGEST_SPOOL_PATH, name)
+        try:
+            with open(path, "rb") as batch_file:
+                batch = json.loads(batch_file.read())
+            store_vantage_results(batch["vantage"], batch["results"])
+        except Exception as e:
+            print(f"Error applying ingested batch {name}: {e}")
+        os.unlink(path)
+
+async def ingest_loop():
+    """
+    Picks up batches pushed to the web workers every PUBLISH_INTERVAL.
+    """
+    os.makedirs(INGEST_SPOOL_PATH, exist_ok=True)
+    while True:
+        await asyncio.sleep(PUBLISH_INTERVAL)
+        try:
+            await asyncio.to_thread(drain_ingest_spool)
+        except Exception as e:
+            print(f"Error reading ingest spool: {e}")
+
+def quorum_health(address, now):
+    """
+    Health of a node across the vantages heard from within VANTAGE_TTL: up
+    when a majority sees it up, down when none does and degraded in between,
+    which usually points at a regional issue. A vantage is judged on its
+    latest result however old, since nodes that keep failing are probed
+    less often. This prober's own results are always current.
+    """
+    reports = dict(vantage_results.get(address, {}))
+    fresh = {
+        vantage: report for vantage, report in reports.items()
+        if vantage == VANTAGE or now - report[3] <= VANTAGE_TTL
+    }
+    if not fresh:
+        return None
+    up = {vantage for vantage, report in fresh.items() if report[0] == STATUS_UP}
+    if len(up) * 2 > len(fresh):
+        state = "up"
+    elif up:
+        state = "degraded"
+    else:
+        state = "down"
+    return {"state": state, "up": len(up), "vantages": len(fresh), "down_from": sorted(fresh.keys() - up)}
+
+async def probe_loop():
+    """
+    Dispatches each node's probe when it falls due, forever. Batches run as
+    separate tasks so a slow batch never delays the nodes due after it.
+    """
+    global history_db, history_flush, alert_queue
+    semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+    scheduler = ProbeScheduler()
+    batches = set()
+    try:
+        history_db = HistoryDatabase(HISTORY_DB_PATH)
+        history_flush = asyncio.Event()
+    except Exception as e:
+        print(f"Error opening history database: {e}")
+    # Nodes restored from the snapshot are probed right away, before the
+    # first registry sync confirms them.
+    for addr in node_states:
+        scheduler.add(addr)
+
+    # Keep references so the background tasks are not garbage collected.
+    registry = asyncio.ensure_future(registry_loop(scheduler))
+    cursors = asyncio.ensure_future(cursor_loop(semaphore))
+    publisher = asyncio.ensure_future(publish_loop())
+    history = asyncio.ensure_future(history_loop())
+    writer = asyncio.ensure_future(history_writer_loop()) if history_db else None
+    rollups = asyncio.ensure_future(rollup_loop()) if history_db else None
+    alert_queue = asyncio.Queue(maxsize=ALERT_QUEUE_SIZE)
+    sinks = [AlertSink(target) for target in ALERT_SINKS]
+    alerting = [asyncio.ensure_future(sink.run()) for sink in sinks]
+    alerting.append(asyncio.ensure_future(alert_loop(sinks)))
+    pusher = asyncio.ensure_future(push_loop()) if AGGREGATOR_URL else None
+    ingester = asyncio.ensure_future(ingest_loop()) if AGGREGATE and ROLE == "prober" else None
+
+    while True:
+        scheduler.wakeup.clear()
+        batch = scheduler.pop_due()
+        if batch:
+            task = asyncio.ensure_future(probe_batch(semaphore, scheduler, batch))
+            batches.add(task)
+            task.add_done_callback(batches.discard)
+
+        try:
+            await asyncio.wait_for(scheduler.wakeup.wait(), timeout=scheduler.next_delay())
+        except asyncio.TimeoutError:
+            pass
+
+class DataSnapshot:
+    """
+    Immutable /data document, encoded once when published. Requests serve
+    the stored bytes, the gzip variant or the ready-made SSE frame without
+    touching live state. It also carries the per-network views, each node's
+    record from node_records and the change log of the last CHANGE_LOG_SIZE
+    versions.
+    """
+    __slots__ = ("version", "networks", "content", "body", "gzip_body", "event", "records", "changes", "deltas")
+
+    def __init__(self, version, networks, content, records, changes):
+        self.version = version
+        self.networks = networks
+        self.content = content
+        self.records = records
+        self.changes = changes
+        self.body = b'{"version":%d,"networks":%s}' % (version, content)
+        self.gzip_body = gzip.compress(self.body)
+        # Compact JSON has no newlines, so it fits on a single data line.
+        self.event = b"id: %d\nevent: data\ndata: %s\n\n" % (version, self.body)
+        # Encoded delta frames by the version they start from.
+        self.deltas = {}
+
+    def delta_event(self, since):
+        """
+        SSE frame with the node changes after version `since`: None when the
+        change log does not reach back that far, empty when nothing changed.
+        """
+        if since not in self.deltas:
+            delta = data_delta(self, since)
+            if delta is None:
+                frame = None
+            elif not delta["networks"]:
+                frame = b""
+            else:
+                frame = b"id: %d\nevent: delta\ndata: %s\n\n" % (
+                    self.version, json.dumps(delta, separators=(",", ":")).encode())
+            self.deltas[since] = frame
+        return self.deltas[since]
+
+def encode_networks(networks):
+    return json.dumps(networks, separators=(",", ":"), sort_keys=True).encode()
+
+def publish_data():
+    """
+    Publishes a new /data snapshot if the document changed. The version only
+    increases when the content does, so unchanged polls get a 304.
+    """
+    global data_snapshot
+    networks = {network: network_view(network) for network in NETWORKS}
+    content = encode_networks(networks)
+    if data_snapshot is not None and content == data_snapshot.content:
+        return
+
+    records = {network: node_records(view) for network, view in networks.items()}
+    previous_records = data_snapshot.records if data_snapshot else {}
+    changes = {}
+    for network in records.keys() | previous_records.keys():
+        before = previous_records.get(network, {})
+        after = records.get(network, {})
+        changed = {address: record for address, record in after.items() if before.get(address) != record}
+        removed = [address for address in before if address not in after]
+        if changed or removed:
+            changes[network] = (changed, removed)
+
+    if data_snapshot is None:
+        # Each run starts numbering at the current time in milliseconds. A
+        # run publishes at most a few versions a second, so versions and
+        # ETags never repeat across restarts, and a since=N from an earlier
+        # run is older than the new change log and gets the full document.
+        version = int(time.time() * 1000)
+        data_snapshot = DataSnapshot(version, networks, content, records, ((version, changes),))
+    else:
+        version = data_snapshot.version + 1
+        log = data_snapshot.changes[-(CHANGE_LOG_SIZE - 1):] + ((version, changes),)
+        data_snapshot = DataSnapshot(version, networks, content, records, log)
+
+    with snapshot_published:
+        snapshot_published.notify_all()
+
+def write_shared_state(kind, data):
+    """
+    Publishes one kind of state for the web workers: "data" when the /data
+    version moves, "metrics" when the body is rebuilt and "extra" (registry,
+    lag, latency, incidents and vantage reports) at most every
+    METRICS_INTERVAL.
+    """
+    write_atomically(f"{SHARED_STATE_PATH}.{kind}", data)
+
+def shared_data():
+    # The network views are spliced in as the already-encoded /data content.
+    snapshot = data_snapshot
+    changes = json.dumps(snapshot.changes[-SHARED_CHANGE_LOG_SIZE:], separators=(",", ":"))
+    return b'{"version":%d,"networks":%s,"changes":%s}' % (snapshot.version, snapshot.content, changes.encode())
+
+def shared_extra():
+    with vantage_lock:
+        reports = {address: dict(by_vantage) for address, by_vantage in vantage_results.items()}
+    return json.dumps({
+        "registry": registry_nodes,
+        "lag": lag_matrix,
+        "latency": latency_percentiles(),
+        "incidents": list(incidents),
+        "vantages": reports,
+    }, separators=(",", ":")).encode()
+
+def load_shared_state(kind, data):
+    """
+    Applies one kind of state published by the prober. New change log
+    entries are appended to the worker's own log; after a gap the log
+    restarts from what the file carries.
+    """
+    global data_snapshot, registry_nodes, lag_matrix, shared_latency, metrics_body, incidents, vantage_results
+    global prober_stale
+    if kind == "metrics":
+        metrics_body = data
+        return
+
+    state = json.loads(data)
+    if kind == "extra":
+        registry_nodes = state["registry"]
+        lag_matrix = state["lag"]
+        shared_latency = state["latency"]
+        incidents = state["incidents"]
+        vantage_results = {
+            address: {vantage: tuple(report) for vantage, report in by_vantage.items()}
+            for address, by_vantage in state["vantages"].items()
+        }
+        return
+
+    if state["version"] == data_snapshot.version and not prober_stale:
+        return
+    log = list(data_snapshot.changes)
+    incoming = state["changes"]
+    if prober_stale or incoming[0][0] > log[-1][0] + 1:
+        log = incoming
+    else:
+        log += [entry for entry in incoming if entry[0] > log[-1][0]]
+    networks = state["networks"]
+    data_snapshot = DataSnapshot(state["version"], networks, encode_networks(networks), {}, log[-CHANGE_LOG_SIZE:])
+    prober_stale = False
+    with snapshot_published:
+        snapshot_published.notify_all()
+
+def serve_stale():
+    """
+    Republishes the last document with every node marked stale. Its version
+    is the current time in milliseconds, which no prober version matches:
+    those count up by one per publish from their run's start time.
+    """
+    global data_snapshot, prober_stale
+    networks = {
+        network: {**view, "stale": list(view["addresses"])}
+        for network, view in data_snapshot.networks.items()
+    }
+    version = int(time.time() * 1000)
+    data_snapshot = DataSnapshot(version, networks, encode_networks(networks), {}, ((version, {}),))
+    prober_stale = True
+    with snapshot_published:
+        snapshot_published.notify_all()
+
+def beat():
+    """
+    Touches the heartbeat file the web workers check the prober by.
+    """
+    path = f"{SHARED_STATE_PATH}.heartbeat"
+    with open(path, "ab"):
+        pass
+    os.utime(path)
+
+def watch_shared_state():
+    """
+    Picks up each new file the prober renames into place. A web worker only
+    ever reads, so any number of them can serve the same state. While the
+    heartbeat is older than SHARED_STALE_AFTER every node is served as
+    stale, and the prober's document comes back once it beats again.
+    """
+    loaded = {}
+    while True:
+        try:
+            beat_age = time.time() - os.stat(f"{SHARED_STATE_PATH}.heartbeat").st_mtime
+        except FileNotFoundError:
+            beat_age = math.inf
+        if beat_age > SHARED_STALE_AFTER:
+            if not prober_stale and data_snapshot.version:
+                serve_stale()
+        elif prober_stale:
+            loaded.pop("data", None)
+
+        for kind in ("data", "metrics", "extra"):
+            path = f"{SHARED_STATE_PATH}.{kind}"
+            try:
+                stat = os.stat(path)
+                if (stat.st_ino, stat.st_mtime_ns) != loaded.get(kind):
+                    with open(path, "rb") as shared_file:
+                        load_shared_state(kind, shared_file.read())
+                    loaded[kind] = (stat.st_ino, stat.st_mtime_ns)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"Error loading shared {kind} state: {e}")
+        time.sleep(PUBLISH_INTERVAL)
+
+def node_records(view):
+    """
+    What a delta carries per node of a network view: status, version, error,
+    health, quorum health and whether it is stale. Uptime and latency move
+    on their own schedule and arrive with the periodic full refresh.
+    """
+    stale = set(view["stale"])
+    quorum = view.get("quorum", {})
+    return {
+        address: (status, view["versions"][address], view["errors"][address],
+                  view["health"].get(address), quorum.get(address), address in stale)
+        for address, status in view["addresses"].items()
+    }
+
+def data_delta(snapshot, since):
+    """
+    Nodes whose record (see node_records) changed after version `since`, and
+    the addresses removed since then. None when the change log no longer
+    reaches back that far.
+    """
+    oldest = snapshot.changes[0][0]
+    if since > snapshot.version or since < oldest - 1:
+        return None
+
+    networks = {}
+    for version, changes in snapshot.changes:
+        if version <= since:
+            continue
+        for network, (changed, removed) in changes.items():
+            delta = networks.setdefault(network, ({}, set()))
+            for address in removed:
+                delta[0].pop(address, None)
+                delta[1].add(address)
+            for address, record in changed.items():
+                delta[1].discard(address)
+                delta[0][address] = record
+
+    return {
+        "version": snapshot.version,
+        "since": since,
+        "delta": True,
+        "networks": {
+            network: {
+                "changed": {
+                    address: {
+                        "status": status, "version": version, "error": error,
+                        "health": health, "quorum": quorum, "stale": stale,
+                    }
+                    for address, (status, version, error, health, quorum, stale) in changed.items()
+                },
+                "removed": sorted(removed),
+            }
+            for network, (changed, removed) in networks.items()
+        },
+    }
+
+async def publish_loop():
+    """
+    Republishes the /data snapshot at most every PUBLISH_INTERVAL while
+    probe or registry results are coming in, and the metrics at most every
+    METRICS_INTERVAL. Probe batches are often a single node, so rebuilding
+    either per batch would keep the loop busy.
+    """
+    global state_changed, extra_changed, metrics_changed
+    metrics_rendered = 0.0
+    # In the prober: the last version shared, and when the extra state was
+    # last shared.
+    shared_version = None
+    extra_shared = 0.0
+
+    while True:
+        await asyncio.sleep(PUBLISH_INTERVAL)
+        if ROLE == "prober":
+            try:
+                beat()
+            except OSError as e:
+                print(f"Error writing heartbeat: {e}")
+        if metrics_changed and time.monotonic() - metrics_rendered >= METRICS_INTERVAL:
+            metrics_changed = False
+            metrics_rendered = time.monotonic()
+            try:
+                render_metrics()
+                if ROLE == "prober":
+                    await asyncio.to_thread(write_shared_state, "metrics", metrics_body)
+            except Exception as e:
+                print(f"Error rendering metrics: {e}")
+        if state_changed:
+            state_changed = False
+            extra_changed = True
+            try:
+                publish_data()
+                if ROLE == "prober" and data_snapshot.version != shared_version:
+                    await asyncio.to_thread(write_shared_state, "data", shared_data())
+                    shared_version = data_snapshot.version
+            except Exception as e:
+                print(f"Error publishing data: {e}")
+        if ROLE == "prober" and extra_changed and time.monotonic() - extra_shared >= METRICS_INTERVAL:
+            extra_changed = False
+            extra_shared = time.monotonic()
+            try:
+                await asyncio.to_thread(write_shared_state, "extra", shared_extra())
+            except Exception as e:
+                print(f"Error sharing state: {e}")
+
+def update_status():
+    """
+    Runs the asyncio probe engine. All gRPC checks share this thread's
+    event loop, so a batch takes about as long as its slowest probe.
+    """
+    asyncio.run(probe_loop())
+
+def network_view(network):
+    """
+    Status of one network's nodes, in the original flat /data layout. Only
+    fields that change with a node's state belong here, since any change
+    publishes a new version; per-probe timings, latency percentiles and
+    replication lag move constantly and are served at /latency and /lag.
+    """
+    states = node_states
+    nodes = [address for address in sorted(network_addresses.get(network, ())) if address in states]
+    now = time.time()
+    view = {
+        "addresses": {address: states[address].status for address in nodes},
+        "versions": {address: states[address].version for address in nodes},
+        "errors": {address: states[address].error for address in nodes},
+        "stale": [address for address in nodes if states[address].stale],
+        "history": {address: history_summaries[address] for address in nodes if address in history_summaries},
+        "health": {
+            address: {"state": node_health[address].state, "flapping": node_health[address].flapping(now)}
+            for address in nodes if address in node_health
+        },
+    }
+    if AGGREGATE:
+        quorum = {address: quorum_health(address, now) for address in nodes}
+        view["quorum"] = {address: health for address, health in quorum.items() if health}
+    return view
+
+if ROLE == "web":
+    # Serve empty views as version 0 until the prober's first publish.
+    empty = {network: network_view(network) for network in NETWORKS}
+    data_snapshot = DataSnapshot(0, empty, encode_networks(empty), {}, ((0, {}),))
+    threading.Thread(target=watch_shared_state, daemon=True).start()
+    if AGGREGATE:
+        os.makedirs(INGEST_SPOOL_PATH, exist_ok=True)
+else:
+    load_snapshot()
+    publish_data()
+
+    # Start gRPC checking in a separate thread.
+    threading.Thread(target=update_status, daemon=True).start()
 
 @app.route("/data")
 def data():
-    return {"addresses": addresses, "versions": versions, "errors": errors}
+    snapshot = data_snapshot
+
+    # /data?since=N returns only what changed after version N, or the full
+    # document when N is older than the change log.
+    since = request.args.get("since", type=int)
+    if since is not None:
+        delta = data_delta(snapshot, since)
+        if delta is not None:
+            return delta
+
+    gzipped = "gzip" in request.accept_encodings
+    etag = f"{snapshot.version}-gzip" if gzipped else str(snapshot.version)
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(snapshot.gzip_body if gzipped else snapshot.body, mimetype="application/json")
+        if gzipped:
+            response.headers["Content-Encoding"] = "gzip"
+
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    # Let browsers cache the body but revalidate it on every poll.
+    response.cache_control.no_cache = True
+    return response
+
+def event_stream(version):
+    """
+    Streams the /data document to a client holding `version` (0 for none).
+    The client gets the full document first, then only the nodes whose
+    status, version, error, health or staleness changed. Versions that only
+    refresh summaries such as uptime go out as a full document at most every
+    SSE_REFRESH_INTERVAL. Frames are encoded once per snapshot and shared.
+    """
+    seen = version
+    refreshed = time.monotonic()
+
+    while True:
+        with snapshot_published:
+            published = snapshot_published.wait_for(lambda: data_snapshot.version != seen, timeout=SSE_KEEPALIVE)
+        snapshot = data_snapshot
+        seen = snapshot.version
+
+        frame = None
+        if snapshot.version != version:
+            delta = snapshot.delta_event(version) if version else None
+            if delta is None or time.monotonic() - refreshed >= SSE_REFRESH_INTERVAL:
+                frame = snapshot.event
+                refreshed = time.monotonic()
+            elif delta:
+                frame = delta
+            if frame:
+                version = snapshot.version
+
+        if frame:
+            yield frame
+        elif not published:
+            yield b": keepalive\n\n"
+
+@app.route("/events")
+def events():
+    # A reconnecting EventSource sends the last version it saw.
+    last_event_id = request.headers.get("Last-Event-ID", "")
+    version = int(last_event_id) if last_event_id.isdigit() else 0
+    if stream_slots and not stream_slots.acquire(blocking=False):
+        return {"error": "Too many open streams, poll /data instead"}, 503
+
+    response = Response(
+        event_stream(version),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    if stream_slots:
+        # The server closes the response once the client has gone.
+        response.call_on_close(stream_slots.release)
+    return response
+
+@app.route("/data/<network>")
+def network_data(network):
+    if network not in NETWORKS:
+        return {"error": f"Unknown network {network}"}, 404
+    return data_snapshot.networks[network]
+
+@app.route("/latency")
+def latency():
+    return shared_latency if ROLE == "web" else latency_percentiles()
+
+def cache_history(key, chunks):
+    """
+    Passes the chunks through and caches the whole body once the stream
+    completes. A client that disconnects early leaves nothing cached.
+    """
+    body = []
+    for chunk in chunks:
+        body.append(chunk)
+        yield chunk
+    with history_cache_lock:
+        history_cache[key] = (time.monotonic() + HISTORY_CACHE_TTL, b"".join(body))
+        while len(history_cache) > HISTORY_CACHE_SIZE:
+            history_cache.popitem(last=False)
+
+@app.route("/history/<address>")
+def history(address):
+    if not any(address in view["addresses"] for view in data_snapshot.networks.values()):
+        return {"error": f"Unknown address {address}"}, 404
+
+    now = time.time()
+    try:
+        end = float(request.args.get("to", now))
+        start = float(request.args.get("from", end - 24 * 3600))
+        points = min(int(request.args.get("points", HISTORY_DEFAULT_POINTS)), HISTORY_MAX_POINTS)
+    except ValueError:
+        return {"error": "from, to and points must be numbers"}, 400
+    # float() also accepts "nan" and "inf", which no bucket can hold.
+    if not (math.isfinite(start) and math.isfinite(end)):
+        return {"error": "from and to must be finite"}, 400
+    # There is no history before the epoch or after now, and clamping keeps
+    # the bounds within what SQLite integers hold.
+    start = min(max(start, 0), now)
+    end = min(max(end, 0), now)
+    if start >= end or points < 1:
+        return {"error": "from must be before to, and points positive"}, 400
+
+    # Align the range to whole buckets, so repeated queries for "the last
+    # day" share a cache entry until a new bucket starts.
+    step = max(math.ceil((end - start) / points), 1)
+    start = int(start) // step * step
+    end = math.ceil(end / step) * step
+
+    key = (address, start, end, step)
+    with history_cache_lock:
+        cached = history_cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            history_cache.move_to_end(key)
+            return Response(cached[1], mimetype="application/json")
+
+    try:
+        connection = sqlite3.connect(f"file:{HISTORY_DB_PATH}?mode=ro", uri=True)
+    except sqlite3.OperationalError:
+        return {"error": "No history recorded yet"}, 503
+    try:
+        source, cursor = query_history(connection, address, start, end, step)
+    except Exception:
+        connection.close()
+        raise
+
+    header = b'{"address":%s,"from":%d,"to":%d,"step":%d,"source":"%s","points":[' % (
+        json.dumps(address).encode(), start, end, step, source.encode())
+    return Response(cache_history(key, history_chunks(connection, cursor, header, start, step)), mimetype="application/json")
+
+@app.route("/incidents")
+def incident_log():
+    # Newest first; open incidents have no close time yet.
+    return {"incidents": list(incidents)[::-1]}
+
+@app.route("/ingest", methods=["POST"])
+def ingest():
+    if not AGGREGATE:
+        return {"error": "This instance does not aggregate results"}, 404
+    if request.headers.get("Authorization") != f"Bearer {INGEST_TOKEN}":
+        return {"error": "Unauthorized"}, 401
+
+    try:
+        body = request.get_data()
+        if request.content_encoding == "gzip":
+            body = gzip.decompress(body)
+        batch = json.loads(body)
+        vantage = str(batch["vantage"])
+        results = [ingested_result(*result) for result in batch["results"]]
+    except Exception as e:
+        return {"error": f"Malformed batch: {e}"}, 400
+
+    now = time.time()
+    results = [(address, code, latency, now - age, now) for address, code, latency, age in results]
+    if ROLE != "web":
+        return {"accepted": store_vantage_results(vantage, results)}
+
+    # Web workers hand the batch to the prober, which holds the results;
+    # they only drop nodes no network here publishes.
+    known = [view["addresses"] for view in data_snapshot.networks.values()]
+    results = [result for result in results if any(result[0] in addresses for addresses in known)]
+    if results:
+        try:
+            if len(os.listdir(INGEST_SPOOL_PATH)) >= INGEST_SPOOL_SIZE:
+                return {"error": "Too many batches waiting for the prober"}, 503
+            name = f"{time.time_ns()}-{os.getpid()}-{threading.get_ident()}.json"
+            batch = json.dumps({"vantage": vantage, "results": results}, separators=(",", ":")).encode()
+            write_atomically(os.path.join(INGEST_SPOOL_PATH, name), batch)
+        except OSError as e:
+            return {"error": f"Could not queue batch: {e}"}, 503
+    return {"accepted": len(results)}
+
+@app.route("/vantages")
+def vantages():
+    now = time.time()
+    with vantage_lock:
+        reports = {address: dict(by_vantage) for address, by_vantage in vantage_results.items()}
+    return {
+        address: {
+            vantage: {"code": code, "latency": latency, "age": round(now - at, 1), "heard": round(now - heard, 1)}
+            for vantage, (code, latency, at, heard) in by_vantage.items()
+        }
+        for address, by_vantage in reports.items()
+    }
+
+@app.route("/registry")
+def registry_view():
+    return registry_nodes
+
+@app.route("/lag")
+def lag():
+    return lag_matrix
+
+@app.route("/metrics")
+def metrics():
+    return Response(metrics_body, mimetype="text/plain; version=0.0.4")
 
 @app.route("/")
 def index():
@@ -226,65 +2487,196 @@ def index():
                 }
             </style>
             <script>
-                function refreshData() {
-                    fetch('/data')  // Fetch updated data from the server
-                        .then(response => response.json())
-                        .then(data => {
-                            let tableBody = document.getElementById("status-table-body");
-                            tableBody.innerHTML = ""; // Clear existing rows
-
-                            Object.keys(data.addresses).sort().forEach(addr => {
-                                let row = tableBody.insertRow();
-                                let cell1 = row.insertCell(0);
-                                let cell2 = row.insertCell(1);
-                                let cell3 = row.insertCell(2);
-
-                                cell1.textContent = addr;
-                                cell2.textContent = data.versions[addr];
-                                if (data.addresses[addr].includes("Error") || data.addresses[addr].includes("Exception")) {
-                                    cell3.innerHTML = `<span class="error-tooltip" title="${data.errors[addr]}">${data.addresses[addr]}</span>`;
-                                } else {
-                                    cell3.textContent = data.addresses[addr];
-                                }
-                            });
-                        })
-                        .catch(error => console.error("Error fetching data:", error));
+                function networkTableBody(network) {
+                    let tableBody = document.getElementById(`status-table-body-${network}`);
+                    if (!tableBody) {
+                        let section = document.getElementById("network-template").content.cloneNode(true);
+                        section.querySelector("h2").textContent = network;
+                        section.querySelector("tbody").id = `status-table-body-${network}`;
+                        document.getElementById("networks").appendChild(section);
+                        tableBody = document.getElementById(`status-table-body-${network}`);
+                    }
+                    return tableBody;
+                }
+
+                // Uptime over the last hour, day and week, and the day's p95.
+                function formatUptime(history) {
+                    return ["1h", "24h", "7d"].map(window => history && history[window] ? `${history[window].uptime}%` : "-").join(" / ");
+                }
+
+                function formatP95(history) {
+                    return history && history["24h"] && history["24h"].p95 !== undefined ? `${history["24h"].p95} ms` : "-";
+                }
+
+                // On an aggregator, also how many vantages see the node up.
+                function formatHealth(health, quorum) {
+                    let text = health ? health.state + (health.flapping ? " (flapping)" : "") : "-";
+                    return quorum ? `${text}, ${quorum.state} ${quorum.up}/${quorum.vantages} vantages` : text;
+                }
+
+                function renderData(data) {
+                    Object.keys(data.networks).forEach(network => {
+                        let view = data.networks[network];
+                        let tableBody = networkTableBody(network);
+                        tableBody.innerHTML = ""; // Clear existing rows
+
+                        Object.keys(view.addresses).sort().forEach(addr => {
+                            let row = tableBody.insertRow();
+                            let cell1 = row.insertCell(0);
+                            let cell2 = row.insertCell(1);
+                            let cell3 = row.insertCell(2);
+                            let cell4 = row.insertCell(3);
+                            let cell5 = row.insertCell(4);
+                            let cell6 = row.insertCell(5);
+
+                            cell1.textContent = addr;
+                            cell2.textContent = view.versions[addr];
+                            if (view.addresses[addr].includes("Error") || view.addresses[addr].includes("Exception")) {
+                                cell3.innerHTML = `<span class="error-tooltip" title="${view.errors[addr]}">${view.addresses[addr]}</span>`;
+                            } else {
+                                cell3.textContent = view.addresses[addr];
+                            }
+                            if (view.stale.includes(addr)) {
+                                cell3.append(" (stale)");
+                            }
+                            cell4.textContent = formatHealth(view.health[addr], view.quorum && view.quorum[addr]);
+                            cell5.textContent = formatUptime(view.history[addr]);
+                            cell6.textContent = formatP95(view.history[addr]);
+                        });
+                    });
+                }
+
+                // Applies the nodes whose status, version, error, health or staleness changed.
+                function applyDelta(data, delta) {
+                    data.version = delta.version;
+                    Object.keys(delta.networks).forEach(network => {
+                        let view = data.networks[network];
+                        let change = delta.networks[network];
+                        change.removed.forEach(addr => {
+                            delete view.addresses[addr];
+                            delete view.versions[addr];
+                            delete view.errors[addr];
+                            delete view.health[addr];
+                            if (view.quorum) delete view.quorum[addr];
+                            view.stale = view.stale.filter(stale => stale !== addr);
+                        });
+                        Object.keys(change.changed).forEach(addr => {
+                            let node = change.changed[addr];
+                            view.addresses[addr] = node.status;
+                            view.versions[addr] = node.version;
+                            view.errors[addr] = node.error;
+                            if (node.health) view.health[addr] = node.health; else delete view.health[addr];
+                            if (view.quorum) {
+                                if (node.quorum) view.quorum[addr] = node.quorum; else delete view.quorum[addr];
+                            }
+                            view.stale = view.stale.filter(stale => stale !== addr);
+                            if (node.stale) view.stale.push(addr);
+                        });
+                    });
                 }
 
-                setInterval(refreshData, 1000);
-                window.onload = refreshData;
+                // The server pushes the full document first, then only what changed.
+                let current = null;
+                let events = new EventSource('/events');
+                events.addEventListener("data", event => {
+                    current = JSON.parse(event.data);
+                    renderData(current);
+                });
+                events.addEventListener("delta", event => {
+                    if (current) {
+                        applyDelta(current, JSON.parse(event.data));
+                        renderData(current);
+                    }
+                });
+                // A stream turned away by the server stays closed; poll instead.
+                let polling = null;
+                events.onerror = error => {
+                    console.error("Error receiving data:", error);
+                    if (events.readyState === EventSource.CLOSED && !polling) {
+                        polling = setInterval(() => {
+                            fetch('/data')
+                                .then(response => response.json())
+                                .then(data => {
+                                    current = data;
+                                    renderData(data);
+                                })
+                                .catch(error => console.error("Error fetching data:", error));
+                        }, 5000);
+                    }
+                };
             </script>
         </head>
 <body>
             <h1>XMTP Node Status</h1>
-            <p>Data refreshes every second</p>
-            <table>
-                <thead>
-                    <tr>
-                        <th>Node Address</th>
-                        <th>Version</th>
-                        <th>Status</th>
-                    </tr>
-                </thead>
-                <tbody id="status-table-body">
-                    {% for addr, status in addresses.items() %}
-                    <tr>
-                        <td>{{ addr }}</td>
-                        <td>{{ versions[addr] }}</td>
-                        <td>
-                            {% if "Error" in status or "Exception" in status %}
-                                <span class="error-tooltip" title="{{ errors[addr] }}">{{ status }}</span>
-                            {% else %}
-                                {{ status }}
-                            {% endif %}
-                        </td>
-                    </tr>
-                    {% endfor %}
-                </tbody>
-            </table>
+            <p>Data updates live</p>
+            <template id="network-template">
+                <h2></h2>
+                <table>
+                    <thead>
+                        <tr>
+                            <th>Node Address</th>
+                            <th>Version</th>
+                            <th>Status</th>
+                            <th>Health</th>
+                            <th>Uptime (1h / 24h / 7d)</th>
+                            <th>p95 latency (24h)</th>
+                        </tr>
+                    </thead>
+                    <tbody></tbody>
+                </table>
+            </template>
+            <div id="networks">
+                {% for network, view in networks.items() %}
+                <h2>{{ network }}</h2>
+                <table>
+                    <thead>
+                        <tr>
+                            <th>Node Address</th>
+                            <th>Version</th>
+                            <th>Status</th>
+                            <th>Health</th>
+                            <th>Uptime (1h / 24h / 7d)</th>
+                            <th>p95 latency (24h)</th>
+                        </tr>
+                    </thead>
+                    <tbody id="status-table-body-{{ network }}">
+                        {% for addr, status in view.addresses.items() %}
+                        <tr>
+                            <td>{{ addr }}</td>
+                            <td>{{ view.versions[addr] }}</td>
+                            <td>
+                                {% if "Error" in status or "Exception" in status %}
+                                    <span class="error-tooltip" title="{{ view.errors[addr] }}">{{ status }}</span>
+                                {% else %}
+                                    {{ status }}
+                                {% endif %}
+                                {% if addr in view.stale %}(stale){% endif %}
+                            </td>
+                            {% set health = view.health.get(addr) %}
+                            {% set quorum = view.quorum.get(addr) if view.quorum else None %}
+                            <td>
+                                {{ health.state ~ (" (flapping)" if health.flapping else "") if health else "-" }}{% if quorum %}, {{ quorum.state }} {{ quorum.up }}/{{ quorum.vantages }} vantages{% endif %}
+                            </td>
+                            {% set history = view.history.get(addr) or {} %}
+                            <td>
+                                {% for window in ("1h", "24h", "7d") %}
+                                    {{ "%s%%"|format(history[window].uptime) if history.get(window) else "-" }}{% if not loop.last %} / {% endif %}
+                                {% endfor %}
+                            </td>
+                            <td>{{ "%s ms"|format(history["24h"].p95) if history.get("24h") and "p95" in history["24h"] else "-" }}</td>
+                        </tr>
+                        {% endfor %}
+                    </tbody>
+                </table>
+                {% endfor %}
+            </div>
         </body>
         </html>
-    """, addresses=addresses, versions=versions, errors=errors)
+    """, networks=data_snapshot.networks)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    if ROLE == "prober":
+        # The probe thread is already running; keep the process alive for it.
+        threading.Event().wait()
+    else:
+        app.run(host="0.0.0.0", port=5000, debug=os.environ.get("FLASK_DEBUG") == "1")
@@ -0,0 +1,42 @@
+import os
+import subprocess
+import sys
+import threading
+
+# Web workers only read what the prober publishes, so they scale across
+# cores without multiplying probe load. Each SSE client holds a thread, so
+# at most half of a worker's threads go to streams and the rest stay free
+# for /data and /metrics.
+bind = "0.0.0.0:5000"
+workers = int(os.environ.get("WEB_WORKERS", os.cpu_count() or 1))
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", "64"))
+raw_env = ["ROLE=web", f"SSE_MAX_STREAMS={max(threads // 2, 1)}"]
+# Pause before restarting a prober that exited, so one that fails on start
+# does not spin.
+PROBER_RESTART_DELAY = 5
+
+def run_prober(server):
+    """
+    Keeps the single prober process running alongside the web workers,
+    restarting it whenever it exits until the server shuts down.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "grpc_status_server.py")
+    while not server.prober_stopping.is_set():
+        server.prober = subprocess.Popen([sys.executable, script], env={**os.environ, "ROLE": "prober"})
+        code = server.prober.wait()
+        if server.prober_stopping.is_set():
+            return
+        server.log.error(f"Prober exited with code {code}, restarting in {PROBER_RESTART_DELAY}s")
+        server.prober_stopping.wait(PROBER_RESTART_DELAY)
+
+def on_starting(server):
+    server.prober_stopping = threading.Event()
+    server.prober_monitor = threading.Thread(target=run_prober, args=(server,), daemon=True)
+    server.prober_monitor.start()
+
+def on_exit(server):
+    server.prober_stopping.set()
+    server.prober.terminate()
+    server.prober.wait()
+    server.prober_monitor.join()